@@ -0,0 +1,92 @@
+"""
+Benchmark cases. Each case takes the SyntheticInputs, does its setup, and returns a function running the measured work
+and returning the number of frames it produced (None when frames do not apply).
+"""
+from moviepy.video.VideoClip import ColorClip
+
+from benchmarks.synthetic import SCRIPT, TITLE
+from src.alignment_cache import AlignmentCache
+from src.media import Media, shift_and_zoom
+from src.utils import Audio
+from src.video_generator import VideoGeneration, extract_and_remove_emojis
+
+FPS = 30
+
+
+def render_frames(clip, fps=FPS):
+    n_frames = int(clip.duration * fps)
+    for i in range(n_frames):
+        clip.get_frame(i / fps)
+    return n_frames
+
+
+def audio_overlay(inputs):
+    voice = Audio(inputs.voice_path)
+    music = Audio(inputs.music_path)
+    # Decoding is not part of the mix
+    voice.get_samples()
+    music.get_samples()
+
+    def run():
+        voice.overlay_audio(music, proportion1=0.82, proportion2=0.18, save_dir=inputs.scratch_dir)
+    return run
+
+
+def media_image(inputs):
+    def run():
+        media = Media(inputs.image_path(1), 4)
+        return render_frames(media.clip)
+    return run
+
+
+def media_video(inputs):
+    def run():
+        media = Media(inputs.video_path(1), 3)
+        return render_frames(media.clip)
+    return run
+
+
+def shift_and_zoom_frames(inputs):
+    media = Media(inputs.image_path(0), 4)
+    frame = media.base_frame
+
+    def run():
+        n_frames = 4 * FPS
+        for i in range(n_frames):
+            shift_and_zoom(lambda t: frame, i / FPS, duration=4)
+        return n_frames
+    return run
+
+
+def overlay_subtitles(inputs):
+    generator = VideoGeneration(inputs.media_dir)
+    script_without_emojis, extracted_emojis = extract_and_remove_emojis(SCRIPT)
+    background = ColorClip(generator.frame_size, color=(40, 80, 120)).set_duration(inputs.voice_duration)
+
+    def run():
+        clip = generator.overlay_subtitles(background, inputs.alignment(), SCRIPT, TITLE, script_without_emojis,
+                                           extracted_emojis)
+        return render_frames(clip, generator.fps)
+    return run
+
+
+def generate_video(inputs):
+    generator = VideoGeneration(inputs.media_dir, scratch_dir=inputs.scratch_dir)
+    generator.video_dir = inputs.output_dir
+    generator.alignment_cache = AlignmentCache(inputs.aligned_dir)
+
+    def run():
+        generator.generate_video(Audio(inputs.voice_path), SCRIPT, TITLE, "benchmark", Audio(inputs.music_path),
+                                 segments=1)
+        return int(inputs.voice_duration * generator.fps)
+    return run
+
+
+CASES = {
+    "audio_overlay": audio_overlay,
+    "media_image": media_image,
+    "media_video": media_video,
+    "shift_and_zoom": shift_and_zoom_frames,
+    "overlay_subtitles": overlay_subtitles,
+    "generate_video": generate_video,
+}
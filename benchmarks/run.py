@@ -0,0 +1,152 @@
+"""
+Benchmarks of the render pipeline on synthetic inputs.
+
+    python -m benchmarks.run run --output results.json
+    python -m benchmarks.run compare baseline.json results.json
+
+Run from the root of the repository, the settings are read from config/.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.cases import CASES
+from benchmarks.synthetic import SyntheticInputs
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec on Linux, a spawned process would report the peak of its parent: VmHWM does not
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if sys.platform == "win32":
+        # The resource module is Unix only, psutil reports the peak working set on Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(name, work_dir, repeat):
+    """
+    Run a case in the current process, which is a fresh one per case so that the peak RSS is the one of this case.
+    """
+    inputs = SyntheticInputs(work_dir)
+    run = CASES[name](inputs)
+    times = []
+    frames = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = run()
+        times.append(time.perf_counter() - start)
+    wall_time = min(times)
+    return {
+        "wall_time": wall_time,
+        "times": times,
+        "frames": frames,
+        "fps": frames / wall_time if frames else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(cases, work_dir, repeat):
+    print("Generating the synthetic inputs")
+    SyntheticInputs(work_dir).generate()
+    results = {}
+    # Spawned processes do not inherit the memory of this one, nor each other's caches
+    context = multiprocessing.get_context("spawn")
+    for name in cases:
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(run_case, (name, work_dir, repeat))
+        result = results[name]
+        fps = f", {result['fps']:.1f} frames/s" if result["fps"] else ""
+        print(f"{name}: {result['wall_time']:.3f}s{fps}, peak RSS {result['peak_rss_mb']:.0f} MB")
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "cases": results,
+    }
+
+
+def compare(baseline, results, threshold):
+    """
+    :return: The names of the cases whose wall time or peak RSS grew by more than `threshold` (a fraction)
+    """
+    regressions = []
+    for name, result in results["cases"].items():
+        if name not in baseline["cases"]:
+            print(f"{name}: not in the baseline")
+            continue
+        base = baseline["cases"][name]
+        time_change = result["wall_time"] / base["wall_time"] - 1
+        rss_change = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        regressed = time_change > threshold or rss_change > threshold
+        flag = "REGRESSION" if regressed else "ok"
+        print(f"{name}: {base['wall_time']:.3f}s -> {result['wall_time']:.3f}s ({time_change:+.1%}), "
+              f"RSS {base['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB ({rss_change:+.1%}) {flag}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of the render pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and write the results as JSON")
+    run_parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    run_parser.add_argument("--work-dir", default="benchmarks/work", help="Where the synthetic inputs are generated")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Runs per case, the fastest one is kept")
+    run_parser.add_argument("--output", default="benchmarks/results.json")
+    compare_parser = subparsers.add_parser("compare", help="Compare results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Relative increase of wall time or peak RSS reported as a regression")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "run":
+        results = run_benchmarks(args.cases, args.work_dir, args.repeat)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.results, "r", encoding="utf-8") as f:
+            results = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
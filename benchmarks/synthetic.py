@@ -0,0 +1,116 @@
+import os
+import subprocess
+
+import cv2
+import numpy as np
+from moviepy.config import get_setting
+
+from src.alignment_cache import AlignmentCache
+from src.utils import Audio, save_wav
+
+SAMPLE_RATE = 44100
+SCRIPT = ("The sky looks blue because the air scatters the short blue wavelengths of sunlight much more than the "
+          "red ones, and at sunset the light crosses so much air that only the reds and oranges reach our eyes")
+TITLE = "Why is the sky blue"
+
+# Name, size and kind of the generated media
+IMAGES = [("photo_portrait.jpg", (1080, 1920)), ("photo_landscape.jpg", (4000, 3000)), ("small_crop-1.png", (640, 480))]
+VIDEOS = [("clip_720p.mp4", (1280, 720), 30, 4), ("clip_1080p_start-1.mp4", (1920, 1080), 60, 4)]
+
+
+def make_image(path, size, seed):
+    """
+    A gradient with noise and a few shapes, so that it compresses and warps like a photo rather than a flat color.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                      np.full((height, width), 128, np.float32)], axis=-1)
+    image += rng.normal(0, 12, image.shape).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    for _ in range(8):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.circle(image, center, int(rng.integers(10, max(11, min(size) // 4))), color, -1)
+    cv2.imwrite(path, image)
+
+
+def make_video(path, size, fps, duration):
+    width, height = size
+    subprocess.run([get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error", "-f", "lavfi",
+                    "-i", f"testsrc2=size={width}x{height}:rate={fps}", "-t", str(duration),
+                    "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path], check=True)
+
+
+def make_tone_track(path, duration, sample_rate=SAMPLE_RATE, channels=1, seed=0):
+    """
+    Bursts of harmonics with pauses, about the level and rhythm of speech, or a steady chord for music.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    signal = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate(rng.uniform(110, 440, 4)))
+    if channels == 1:
+        signal *= (np.sin(2 * np.pi * 2.5 * t) > -0.3)  # Words and pauses
+    samples = (signal / np.abs(signal).max() * 12000).astype(np.int16)
+    samples = np.repeat(samples[:, None], channels, axis=1)
+    save_wav(samples.tobytes(), path, n_channels=channels, framerate=sample_rate)
+    return path
+
+
+def canned_alignment(text, duration):
+    """
+    An alignment in the pyfoal format with the words spread evenly over the voice.
+    """
+    words = text.split()
+    step = duration / len(words)
+    return {"words": [{"alignedWord": word.lower().strip(",."), "start": i * step, "end": (i + 0.85) * step}
+                      for i, word in enumerate(words)]}
+
+
+class SyntheticInputs:
+    """
+    Inputs of the benchmarks, generated with fixed seeds in `work_dir` so that every run measures the same work.
+    """
+
+    def __init__(self, work_dir, voice_duration=20.0):
+        self.work_dir = os.path.abspath(work_dir)
+        self.voice_duration = voice_duration
+        self.media_dir = os.path.join(self.work_dir, "medias")
+        self.output_dir = os.path.join(self.work_dir, "videos")
+        self.scratch_dir = os.path.join(self.work_dir, "scratch")
+        self.aligned_dir = os.path.join(self.work_dir, "aligned")
+        self.voice_path = os.path.join(self.work_dir, "voice.wav")
+        self.music_path = os.path.join(self.work_dir, "music.wav")
+
+    def image_path(self, index=0):
+        return os.path.join(self.media_dir, IMAGES[index][0])
+
+    def video_path(self, index=0):
+        return os.path.join(self.media_dir, VIDEOS[index][0])
+
+    def generate(self):
+        for folder in (self.media_dir, self.output_dir, self.scratch_dir, self.aligned_dir):
+            os.makedirs(folder, exist_ok=True)
+        for seed, (name, size) in enumerate(IMAGES):
+            if not os.path.isfile(os.path.join(self.media_dir, name)):
+                make_image(os.path.join(self.media_dir, name), size, seed)
+        for name, size, fps, duration in VIDEOS:
+            if not os.path.isfile(os.path.join(self.media_dir, name)):
+                make_video(os.path.join(self.media_dir, name), size, fps, duration)
+        if not os.path.isfile(self.voice_path):
+            make_tone_track(self.voice_path, self.voice_duration)
+        if not os.path.isfile(self.music_path):
+            make_tone_track(self.music_path, self.voice_duration + 10, sample_rate=48000, channels=2, seed=1)
+        self.seed_alignment()
+        return self
+
+    def alignment(self):
+        return canned_alignment(SCRIPT, self.voice_duration)
+
+    def seed_alignment(self):
+        # generate_video finds the alignment in the cache and never calls pyfoal
+        cache = AlignmentCache(self.aligned_dir)
+        voice = Audio(self.voice_path)
+        cache.put(cache.key(SCRIPT, voice.get_audio_np_array(), voice.get_sample_rate()), self.alignment())
@@ -1,46 +1,164 @@
-import os
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from pydub import AudioSegment
-
-from src.csv_reader import CSVReader
-from src.text_to_speech import TextToSpeech
+from src import tracing
+from src.batch_renderer import BatchRenderer
+from src.csv_reader import CSVReader, CSVCheckpoint, CSVProgress
+from src.job_runner import store_worker
+from src.job_store import JobStore
 from src.uploader import Uploader
-from src.utils import Config, Audio
-from src.video_generator import VideoGeneration
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate short videos from a CSV file.")
+    parser.add_argument("--csv", default="SkyColors", help="Name of the CSV file in the csv/ folder, without extension")
+    parser.add_argument("--workers", type=int, default=1, help="Number of videos rendered in parallel processes")
+    parser.add_argument("--refresh-alignment", action="store_true",
+                        help="Recompute the forced alignments instead of using the ones cached in aligned_dir")
+    parser.add_argument("--draft", action="store_true",
+                        help="Render quick low resolution previews (see the draft settings), saved as <name>_draft.mp4")
+    parser.add_argument("--segments", type=int, default=None,
+                        help="Render each video in this many segments in parallel (encoding.segments by default)")
+    parser.add_argument("--trace", metavar="DIR", default=None,
+                        help="Write the duration and memory of each stage and per-frame timings to DIR")
+    parser.add_argument("--force", action="store_true",
+                        help="Render every entry, also the ones whose video is up to date with its inputs")
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="Number of rows read and rendered at a time, without --pipeline")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from the row reached by the last run on this CSV instead of the first row")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Synthesize, mix and align the voices of the next videos while the current ones are "
+                             "rendered, each stage with its own workers (see the pipeline settings)")
+    parser.add_argument("--store", action="store_true",
+                        help="Queue the rows in the job store (job_store.path) and render them from there, each row "
+                             "resumes from its last completed stage and other runs can work on the same store")
+    parser.add_argument("--upload", action="store_true",
+                        help="With --store, upload the videos once rendered")
+    parser.add_argument("--status", action="store_true",
+                        help="Show the jobs of the store per status and stage, the queue depth and the throughput")
+    return parser.parse_args()
+
+
+def chunks(entries, size):
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_results(args, batch_renderer, entries):
+    """
+    :return: A generator of the RenderResult of the entries, in the order they are done
+    """
+    if args.pipeline:
+        # A single pipeline for the whole CSV: the voices of the next rows are prepared while the last ones encode
+        yield from batch_renderer.run_pipelined(entries)
+        return
+    for videos in chunks(entries, max(1, args.chunk_size)):
+        yield from batch_renderer.run(videos)
+
+
+def run_store(args, csv_reader):
+    """
+    Queue the rows of the CSV in the job store and work on them with `workers` processes.
+
+    :return: The number of jobs rendered, skipped (up to date) and failed by this run
+    """
+    store = JobStore()
+    # The output names are counted over the whole CSV and recorded with the jobs, so two rows never share a video
+    naming = BatchRenderer(args.csv)
+    naming.count_names(CSVReader(csv_reader.file_path).iter_entries())
+    queued = store.enqueue(args.csv, csv_reader.iter_entries(), naming.output_name)
+    # Jobs of workers that died and failed jobs are resumed from their last completed stage
+    resumed = store.requeue_dead_workers() + store.retry_failed(args.csv)
+    print(f"{queued} jobs queued, {resumed} resumed")
+    # The workers open their own connection, a forked process must not use the one of its parent
+    store.close()
+    worker_args = (store.path, args.csv, args.draft, args.refresh_alignment, args.force, args.segments, args.upload)
+    counts = Counter()
+    if args.workers == 1:
+        counts.update(store_worker(*worker_args))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for worker_counts in executor.map(store_worker, *zip(*[worker_args] * args.workers)):
+                counts.update(worker_counts)
+    for job in store.failures(args.csv):
+        completed = f"after the {job.stage} stage" if job.stage else "before any stage completed"
+        print(f"Row {job.row} failed {completed}: {job.error}")
+    store.print_status(args.csv)
+    return counts
 
 
 def main():
-    # Read CSV
-    config = Config()
-    csv_name = "SkyColors"
-    csv_reader = CSVReader(f"csv/{csv_name}.csv")
-    tts = TextToSpeech()
-    videos = csv_reader.get_video_entries()
-
-    for video in videos:
-        media_folder = config.image_dir
-        if video.filename is None:
-            media_folder += f"{csv_name}/"
-        else:
-            media_folder += video.filename
-        video_generator = VideoGeneration(media_folder)
-
-        # Generate audio from script
-        audio_object = tts.get_audio(video.script) if not video.script.isspace() and video.script else Audio(audio_segment=AudioSegment.silent(duration=40000))
-        music_file_path = os.path.join(config.music_dir, f"1.mp3")
-        music_object = Audio(music_file_path)
-        video_file_path = video_generator.generate_video(audio_object, video.script, video.title,
-                                                         video.filename or csv_name, music_object)
-
-        # (Optional) Upload video to a platform
-        # uploader = Uploader(video)
-        # schedule = True
-        # schedule_day = "17"
-        # schedule_time = "00:30"
-        # # uploader.upload_to_youtube(schedule, schedule_day, schedule_time)
-        # # uploader.upload_to_tiktok(schedule, schedule_day, schedule_time)
-        # # uploader.upload_to_instagram(schedule, schedule_day, schedule_time)
-        # uploader.upload_to_all(schedule, schedule_day, schedule_time)
+    args = parse_args()
+    if args.status:
+        JobStore().print_status()
+        return
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.store:
+        with tracing.span("main"):
+            csv_reader = CSVReader(f"csv/{args.csv}.csv")
+            counts = run_store(args, csv_reader)
+        if args.trace:
+            tracing.flush()
+            print(f"Trace written to {tracing.merge(args.trace)}")
+        print(f"{counts['rendered']} videos rendered, {counts['skipped']} up to date, {counts['failed']} failed")
+        for error in csv_reader.errors:
+            print(f"{error}, skipped")
+        return
+    with tracing.span("main"):
+        # The CSV is read as the videos are rendered, the row reached is saved as the videos are done
+        csv_name = args.csv
+        csv_path = f"csv/{csv_name}.csv"
+        csv_reader = CSVReader(csv_path)
+        checkpoint = CSVCheckpoint(csv_path)
+        start = checkpoint.load() if args.resume else None
+        if start is not None:
+            print(f"Resuming {csv_path} from row {start.row}")
+
+        batch_renderer = BatchRenderer(csv_name, workers=args.workers, refresh_alignment=args.refresh_alignment,
+                                       draft=args.draft, force=args.force, segments=args.segments)
+        # The output names are counted over the whole CSV, so they are the same whatever the chunks and the resume row
+        batch_renderer.count_names(CSVReader(csv_path).iter_entries())
+        progress = CSVProgress(csv_reader)
+        total, skipped, failures = 0, 0, []
+        for result in render_results(args, batch_renderer, progress.track(csv_reader.iter_entries(start))):
+            total += 1
+            skipped += result.skipped
+            if not result.ok:
+                failures.append(result)
+            # Entries are done out of order in the pipeline, the checkpoint only moves past rows that are all done
+            position = progress.complete(result.job.index)
+            if position is not None:
+                checkpoint.save(position)
+        checkpoint.clear()
+    if args.trace:
+        tracing.flush()
+        print(f"Trace written to {tracing.merge(args.trace)}")
+
+    print(f"{total - len(failures) - skipped}/{total} videos rendered, {skipped} up to date")
+    for result in failures:
+        print(f"Row {result.job.index} ({result.job.output_name}) failed:\n{result.traceback_text or result.error}")
+    for error in csv_reader.errors:
+        print(f"{error}, skipped")
+
+    # (Optional) Upload the videos to the platforms: run with --store --upload, each video is uploaded once rendered
+    # and an upload that failed is retried by the next run. To schedule the uploads, upload a rendered video with:
+    # uploader = Uploader(video_entry, file_path=video_path)
+    # schedule = True
+    # schedule_day = "17"
+    # schedule_time = "00:30"
+    # # uploader.upload_to_youtube(schedule, schedule_day, schedule_time)
+    # # uploader.upload_to_tiktok(schedule, schedule_day, schedule_time)
+    # # uploader.upload_to_instagram(schedule, schedule_day, schedule_time)
+    # uploader.upload_to_all(schedule, schedule_day, schedule_time)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import glob
+import json
+import os
+import re
+from hashlib import sha256
+
+from src.utils import get_config, atomic_write_json
+
+# The files of the cache are named after the sha256 of their key, other files of aligned_dir are not touched
+_ENTRY_NAME = re.compile(r"[0-9a-f]{64}\.json")
+
+
+class AlignmentCache:
+    """
+    Forced-alignment results stored in aligned_dir, keyed by a hash of the cleaned script text, the audio samples
+    given to the aligner and their sample rate. Re-rendering the same script and voice skips the alignment.
+    """
+
+    def __init__(self, aligned_dir=None):
+        self.aligned_dir = aligned_dir if aligned_dir is not None else get_config().aligned_dir
+
+    @staticmethod
+    def key(text, samples, sample_rate):
+        digest = sha256()
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(sample_rate).encode())
+        digest.update(b"\0")
+        digest.update(samples.tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.aligned_dir, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, alignment):
+        atomic_write_json(self.path(key), alignment)
+
+    def clear(self):
+        """
+        Remove every cached alignment, and only them: aligned_dir may be a folder holding other files.
+        """
+        for path in glob.glob(os.path.join(self.aligned_dir, "*.json")):
+            if _ENTRY_NAME.fullmatch(os.path.basename(path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
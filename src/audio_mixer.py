@@ -0,0 +1,178 @@
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+from scipy.signal import firwin, resample_poly
+
+# Zero crossings of the resampling filter on each side, scipy uses 10. The error in the audible band stays around
+# -60 dB, below what is heard under the voice, for less than half the filtering time.
+RESAMPLE_HALF_LENGTH = 4
+
+
+def int_scale(dtype):
+    # Full scale of integer PCM samples, 1 for float samples
+    dtype = np.dtype(dtype)
+    return 1.0 if dtype.kind == "f" else float(2 ** (8 * dtype.itemsize - 1))
+
+
+def to_float(samples):
+    """
+    Convert integer PCM samples of shape (n, channels) to float32 in [-1, 1].
+    """
+    if samples.dtype == np.float32:
+        return samples
+    converted = samples.astype(np.float32)
+    converted *= np.float32(1 / int_scale(samples.dtype))
+    return converted
+
+
+def to_int16(samples):
+    """
+    Convert float samples in [-1, 1] to int16 PCM, saturating like pydub's overlay does.
+    """
+    # In place, the float buffer is not used after the conversion
+    samples *= np.float32(32768.0)
+    np.rint(samples, out=samples)
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype(np.int16)
+
+
+def resample(samples, source_rate, target_rate):
+    """
+    Resample float samples of shape (n, channels) with a polyphase filter.
+    """
+    if source_rate == target_rate:
+        return samples
+    divisor = gcd(int(source_rate), int(target_rate))
+    up, down = int(target_rate) // divisor, int(source_rate) // divisor
+    # Filtering each channel as a contiguous row is faster than along axis 0 of interleaved samples
+    resampled = resample_poly(np.ascontiguousarray(samples.T), up, down, axis=1, window=resample_filter(up, down))
+    return resampled.T.astype(np.float32, copy=False)
+
+
+@lru_cache(maxsize=None)
+def resample_filter(up, down):
+    # Low-pass at the lowest of the two Nyquist frequencies, with the Kaiser window scipy uses by default
+    max_rate = max(up, down)
+    return firwin(2 * RESAMPLE_HALF_LENGTH * max_rate + 1, 1 / max_rate, window=("kaiser", 5.0)).astype(np.float32)
+
+
+def match_channels(samples, channels):
+    """
+    Bring samples to a number of channels. Mono samples are left as they are, NumPy broadcasts them over the channels.
+    """
+    if samples.shape[1] == channels or samples.shape[1] == 1:
+        return samples
+    mono = samples.mean(axis=1, keepdims=True)
+    return np.repeat(mono, channels, axis=1) if channels > 1 else mono
+
+
+def proportion_to_gain(proportion):
+    # Same loudness as subtracting (1 - proportion) * 20 dB, as the pydub mixing did
+    return 10 ** (proportion - 1)
+
+
+def fade_envelope(n_samples, sample_rate, fade_in=0.0, fade_out=0.0):
+    """
+    Linear fade-in at the start and fade-out at the end of a track of n_samples.
+    """
+    envelope = np.ones(n_samples, dtype=np.float32)
+    fade_in_samples = min(n_samples, int(fade_in * sample_rate))
+    if fade_in_samples > 0:
+        envelope[:fade_in_samples] = np.linspace(0, 1, fade_in_samples, dtype=np.float32)
+    fade_out_samples = min(n_samples, int(fade_out * sample_rate))
+    if fade_out_samples > 0:
+        envelope[n_samples - fade_out_samples:] *= np.linspace(1, 0, fade_out_samples, dtype=np.float32)
+    return envelope
+
+
+def ducking_envelope(voice, sample_rate, duck_db, threshold_db=-35.0, window=0.05, attack=0.05, release=0.3):
+    """
+    Gain to apply to the music so that it is lowered by duck_db while the voice is speaking.
+
+    :param voice: Mono float samples of the voice
+    :param sample_rate: Sample rate of the voice
+    :param duck_db: Attenuation of the music during speech, in dB
+    :param threshold_db: Level of the voice above which it is considered speaking, in dBFS
+    :param window: Length of the windows the voice level is measured on, in seconds
+    :param attack: Time constant of the gain going down when speech starts, in seconds
+    :param release: Time constant of the gain going back up when speech stops, in seconds
+    :return: float32 gain per sample
+    """
+    n_samples = len(voice)
+    window_samples = max(1, int(sample_rate * window))
+    n_windows = -(-n_samples // window_samples)
+    padded = np.zeros(n_windows * window_samples, dtype=np.float32)
+    padded[:n_samples] = voice
+    rms = np.sqrt(np.mean(padded.reshape(n_windows, window_samples) ** 2, axis=1))
+    speaking = 20 * np.log10(rms + 1e-9) > threshold_db
+    targets = np.where(speaking, 10 ** (-duck_db / 20), 1.0)
+
+    # One-pole smoothing between windows, only a few values per second so a python loop is fine
+    attack_coefficient = np.exp(-window / attack) if attack > 0 else 0.0
+    release_coefficient = np.exp(-window / release) if release > 0 else 0.0
+    gains = np.empty(n_windows, dtype=np.float32)
+    gain = 1.0
+    for i, target in enumerate(targets):
+        coefficient = attack_coefficient if target < gain else release_coefficient
+        gain = target + (gain - target) * coefficient
+        gains[i] = gain
+    centers = (np.arange(n_windows) + 0.5) * window_samples
+    return np.interp(np.arange(n_samples), centers, gains).astype(np.float32)
+
+
+class AudioMixer:
+    """
+    Mix a voice and a music track on float32 NumPy arrays: the music is resampled to the voice rate, cut to the voice
+    length, and scaled by its gain, its fade envelope and, if enabled, a ducking envelope following the voice.
+    """
+
+    def __init__(self, music_fade_in=0.0, music_fade_out=0.0, duck_db=0.0, duck_threshold_db=-35.0):
+        self.music_fade_in = music_fade_in
+        self.music_fade_out = music_fade_out
+        self.duck_db = duck_db
+        self.duck_threshold_db = duck_threshold_db
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.music_fade_in, config.music_fade_out, config.duck_db, config.duck_threshold_db)
+
+    def mix(self, voice, voice_rate, music, music_rate, voice_gain=1.0, music_gain=1.0, position_ms=0):
+        """
+        :param voice: Voice PCM samples, shape (n, channels)
+        :param voice_rate: Sample rate of the voice, also the rate of the mix
+        :param music: Music PCM samples, shape (m, channels)
+        :param music_rate: Sample rate of the music
+        :param voice_gain: Linear gain of the voice
+        :param music_gain: Linear gain of the music
+        :param position_ms: Position in the voice where the music starts
+        :return: int16 samples of the mix, with the length of the voice and the channels of the widest track
+        """
+        # Like pydub's overlay, a mono track mixed with a stereo one gives a stereo mix
+        channels = max(voice.shape[1], music.shape[1])
+        voice = match_channels(voice, channels)
+        n_samples = len(voice)
+        start = min(n_samples, int(position_ms * voice_rate / 1000))
+
+        # Only resample the part of the music that is heard
+        music = music[:int(np.ceil((n_samples - start) * music_rate / voice_rate)) + 1]
+        music = match_channels(resample(to_float(music), music_rate, voice_rate), channels)
+        music = music[:n_samples - start]
+
+        # The gain and the int to float scaling are applied in one pass, into a new buffer: the voice samples may be a
+        # read-only view of the decoded audio. A mono track is broadcast over the channels of the mix.
+        mixed = np.empty((n_samples, channels), dtype=np.float32)
+        np.multiply(voice, np.float32(voice_gain / int_scale(voice.dtype)), out=mixed)
+        music_part = mixed[start:start + len(music)]
+        if self.music_fade_in > 0 or self.music_fade_out > 0 or self.duck_db > 0:
+            music_envelope = fade_envelope(len(music), voice_rate, self.music_fade_in, self.music_fade_out)
+            music_envelope *= np.float32(music_gain)
+            if self.duck_db > 0:
+                music_envelope *= ducking_envelope(music_part.mean(axis=1) / np.float32(voice_gain or 1), voice_rate,
+                                                   self.duck_db, self.duck_threshold_db)
+            music *= music_envelope[:, None]
+        else:
+            # Constant gain, no envelope to build
+            music *= np.float32(music_gain)
+        music_part += music
+        return to_int16(mixed)
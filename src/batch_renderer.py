@@ -0,0 +1,442 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from pydub import AudioSegment
+
+from src import tracing
+from src.music_cache import MusicCache
+from src.pipeline import Pipeline, Stage
+from src.render_manifest import RenderManifest
+from src.text_to_speech import TextToSpeech, TTSPrefetcher
+from src.utils import get_config, Audio
+from src.video_generator import VideoGeneration, video_file_path
+
+# One TextToSpeech per worker process, created lazily by the first job it runs
+_worker_tts = None
+
+
+class RenderJob:
+    def __init__(self, index, entry, media_folder, output_name, music_path=None, refresh_alignment=False,
+                 draft=False, video_path=None, input_digest=None, inputs=None, segments=None, overrides=None):
+        self.index = index  # Position of the entry in the CSV, VideoEntry.index
+        self.entry = entry
+        self.media_folder = media_folder
+        self.output_name = output_name  # Output file name, without the .mp4 extension
+        self.music_path = music_path
+        self.refresh_alignment = refresh_alignment
+        self.draft = draft  # Render a low resolution preview
+        self.video_path = video_path  # Where the video will be saved
+        # Hash of the inputs of the video, recorded in its manifest once rendered
+        self.input_digest = input_digest
+        self.inputs = inputs
+        self.segments = segments  # Number of segments the video is rendered in, from the settings if None
+        # Settings of this video layered over the ones of the process, see Config.with_overrides
+        self.overrides = overrides if overrides is not None else {}
+
+    def config(self):
+        return get_config().with_overrides(self.overrides)
+
+
+class RenderResult:
+    def __init__(self, job, video_path=None, error=None, traceback_text=None, elapsed=0.0, skipped=False):
+        self.job = job
+        self.skipped = skipped  # The video was up to date and not rendered again
+        self.video_path = video_path
+        self.error = error
+        self.traceback_text = traceback_text
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _get_tts():
+    global _worker_tts
+    if _worker_tts is None:
+        _worker_tts = TextToSpeech()
+    return _worker_tts
+
+
+def render_job(job):
+    """
+    Render a single job. Runs in a worker process, so every error is caught and returned in the result
+    instead of being raised, and all intermediate files go to a scratch folder owned by this job.
+
+    :param job: The RenderJob to render
+    :return: A RenderResult
+    """
+    start = time.time()
+    audio_dir = get_config().audio_dir
+    os.makedirs(audio_dir, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=f"job_{job.index:05d}_", dir=audio_dir)
+    try:
+        with tracing.span("render_job", index=job.index, output=job.output_name):
+            video = job.entry
+            config = job.config()
+            video_generator = VideoGeneration(job.media_folder, scratch_dir=scratch_dir,
+                                              refresh_alignment=job.refresh_alignment, config=config)
+
+            # Generate audio from script
+            with tracing.span("tts"):
+                if video.script and not video.script.isspace():
+                    audio_object = _get_tts().get_audio(video.script)
+                else:
+                    audio_object = Audio(audio_segment=AudioSegment.silent(duration=40000), scratch_dir=scratch_dir)
+            # The music bed is decoded once at the rate of the voice and then mapped from the cache by every job
+            music_object = None
+            if job.music_path is not None:
+                with tracing.span("music"):
+                    music_object = MusicCache().get_audio(job.music_path, audio_object.get_sample_rate(), scratch_dir)
+            manifest = RenderManifest(config)
+            manifest.remove(job.video_path)
+            video_path = video_generator.generate_video(audio_object, video.script, video.title,
+                                                        job.output_name, music_object, draft=job.draft,
+                                                        segments=job.segments)
+            if job.input_digest is not None:
+                manifest.write(video_path, job.input_digest, job.inputs)
+            return RenderResult(job, video_path=video_path, elapsed=time.time() - start)
+    except Exception as e:
+        return RenderResult(job, error=f"{type(e).__name__}: {e}", traceback_text=traceback.format_exc(),
+                            elapsed=time.time() - start)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        # Worker processes exit without running atexit handlers
+        tracing.flush()
+        if _worker_tts is not None:
+            _worker_tts.cache.flush()
+
+
+class PreparedJob:
+    """
+    A job going through the stages of the pipeline, with what the stages before the render produced.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.start = time.time()
+        self.scratch_dir = None
+        self.voice_path = None
+        self.voice = None  # The decoded voice, shared by the stages running in this process
+        self.audio_path = None  # The voice mixed with the music
+        self.alignment = None
+        self.result = None  # The RenderResult, once rendered
+
+
+def render_prepared_job(prepared):
+    """
+    Render a job whose voice, mixed audio and alignment were prepared by the previous stages of the pipeline. Runs in
+    a worker process, errors are raised and reported by the pipeline.
+
+    :return: A RenderResult
+    """
+    job = prepared.job
+    try:
+        with tracing.span("render_job", index=job.index, output=job.output_name):
+            config = job.config()
+            video = job.entry
+            video_generator = VideoGeneration(job.media_folder, scratch_dir=prepared.scratch_dir, config=config)
+            manifest = RenderManifest(config)
+            manifest.remove(job.video_path)
+            video_path = video_generator.generate_video(Audio(prepared.voice_path), video.script, video.title,
+                                                        job.output_name, draft=job.draft, segments=job.segments,
+                                                        video_audio=Audio(prepared.audio_path),
+                                                        alignment=prepared.alignment)
+            if job.input_digest is not None:
+                manifest.write(video_path, job.input_digest, job.inputs)
+            return RenderResult(job, video_path=video_path, elapsed=time.time() - prepared.start)
+    finally:
+        # Worker processes exit without running atexit handlers
+        tracing.flush()
+
+
+def _process_context():
+    # The pipeline threads may hold locks when a render process is started, a forked child would inherit them locked:
+    # the fork server forks the render processes from a process without threads
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class BatchRenderer:
+    def __init__(self, csv_name, workers=1, refresh_alignment=False, draft=False, force=False, segments=None):
+        self.config = get_config()
+        self.csv_name = csv_name
+        self.workers = max(1, workers)
+        self.refresh_alignment = refresh_alignment
+        self.draft = draft
+        # Render every entry, also the ones whose video is up to date
+        self.force = force
+        self.segments = segments
+        self.music_path = os.path.join(self.config.music_dir, f"1.mp3")
+        self.name_counts = None  # How many entries of the CSV share each output name, see count_names
+
+    def count_names(self, videos):
+        """
+        Count how many entries of the CSV share each output name, in one pass over the entries that only keeps the
+        names, so the output name of an entry does not depend on the chunk it is rendered in.
+
+        :param videos: Iterable of all the VideoEntry of the CSV, e.g. CSVReader.iter_entries()
+        """
+        self.name_counts = Counter(video.filename or self.csv_name for video in videos)
+        return self.name_counts
+
+    def output_name(self, video, name_counts=None):
+        """
+        The output name of an entry is its media folder name, or the name of the CSV for the entries without one. A name
+        shared by several rows of the CSV gets the row index appended, otherwise their videos would overwrite each
+        other.
+
+        :param name_counts: The counts of the names of all the entries, see count_names
+        """
+        name = video.filename or self.csv_name
+        name_counts = name_counts if name_counts is not None else self.name_counts
+        return f"{name}_{video.index}" if name_counts[name] > 1 else name
+
+    def build_jobs(self, videos, output_names=None):
+        """
+        Create one RenderJob per video entry.
+
+        :param videos: The VideoEntry objects
+        :param output_names: The output name of each entry, see output_name by default. The names are counted over the
+            whole CSV once count_names was called, over `videos` otherwise
+        """
+        name_counts = self.name_counts
+        if name_counts is None:
+            name_counts = Counter(video.filename or self.csv_name for video in videos)
+        jobs = []
+        for i, video in enumerate(videos):
+            index = video.index
+            overrides = dict(video.settings)
+            music = overrides.pop("music", None)
+            music_path = os.path.join(self.config.music_dir, music) if music else self.music_path
+            media_folder = self.config.image_dir
+            if video.filename is None:
+                media_folder += f"{self.csv_name}/"
+            else:
+                media_folder += video.filename
+            output_name = output_names[i] if output_names is not None else self.output_name(video, name_counts)
+            jobs.append(RenderJob(index, video, media_folder, output_name, music_path, self.refresh_alignment,
+                                  self.draft, video_file_path(self.config.video_dir, output_name, self.draft),
+                                  segments=self.segments, overrides=overrides))
+        return jobs
+
+    def hash_inputs(self, jobs):
+        """
+        Record the hash of the inputs of every job, it is compared with the manifest of the existing video.
+        """
+        tts = None
+        for job in jobs:
+            try:
+                manifest = RenderManifest(job.config())
+            except (KeyError, ValueError):
+                # Invalid settings in the row, the job is rendered and fails with the error
+                continue
+            voice_key = None
+            if job.entry.script and not job.entry.script.isspace():
+                if tts is None:
+                    tts = _get_tts()
+                voice_key = tts.cache_key(job.entry.script)
+            job.inputs = manifest.inputs(job.entry.script, job.entry.title, voice_key, job.music_path,
+                                         job.media_folder, job.draft)
+            job.input_digest = manifest.digest(job.inputs)
+
+    def split_up_to_date(self, jobs):
+        """
+        :return: The jobs to render and the RenderResult of the jobs whose video is up to date
+        """
+        manifest = RenderManifest(self.config)
+        to_render, up_to_date = [], []
+        for job in jobs:
+            if not self.force and manifest.is_up_to_date(job.video_path, job.input_digest):
+                up_to_date.append(RenderResult(job, video_path=job.video_path, skipped=True))
+            else:
+                to_render.append(job)
+        return to_render, up_to_date
+
+    def run(self, videos):
+        """
+        Render all the video entries, with at most `workers` jobs running at the same time.
+
+        :param videos: The VideoEntry objects to render
+        :return: The list of RenderResult, in the same order as the entries
+        """
+        jobs = self.build_jobs(videos)
+        results = {}
+        # Entries whose inputs did not change since their video was rendered are not rendered again
+        with tracing.span("hash_inputs"):
+            self.hash_inputs(jobs)
+        to_render, up_to_date = self.split_up_to_date(jobs)
+        for result in up_to_date:
+            results[result.job.index] = result
+        if up_to_date:
+            print(f"{len(up_to_date)} videos up to date, {len(to_render)} to render")
+
+        # Synthesize all the voice tracks first, so that rendering starts with every voice on disk
+        with tracing.span("tts_prefetch"):
+            tts_failures = TTSPrefetcher().prefetch(job.entry.script for job in to_render)
+        pending = []
+        for job in to_render:
+            if job.entry.script in tts_failures:
+                results[job.index] = RenderResult(job, error=f"Text to speech failed: {tts_failures[job.entry.script]}")
+                self._report(results[job.index])
+            else:
+                pending.append(job)
+
+        if self.workers == 1:
+            for job in pending:
+                results[job.index] = render_job(job)
+                self._report(results[job.index])
+        else:
+            crashed_once = set()
+            while pending:
+                pending = self._run_pool(pending, results, crashed_once)
+        return [results[job.index] for job in jobs]
+
+    def run_pipelined(self, videos):
+        """
+        Render the video entries through a pipeline of stages, each with its own workers and a bounded queue: the
+        voices of the next entries are synthesized, mixed and aligned in threads while the previous ones are rendered
+        in `workers` processes. The pipeline, its rate limit and its render processes are created once and the entries
+        are read as the first stage has room, so a whole CSV can be given as a generator. The occupancy of every stage
+        is printed at the end, to size the pools.
+
+        :param videos: Iterable of the VideoEntry objects to render, e.g. CSVReader.iter_entries()
+        :return: A generator of the RenderResult, in the order the entries are done
+        """
+        os.makedirs(self.config.audio_dir, exist_ok=True)
+        self._prefetcher = TTSPrefetcher(tts=_get_tts())
+        self._render_pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_process_context())
+        self._render_pool_lock = threading.Lock()
+        queue_size = self.config.pipeline_queue_size
+        pipeline = Pipeline([
+            Stage("check", self._check_stage, 1, queue_size),
+            Stage("tts", self._tts_stage, self._prefetcher.max_concurrency, queue_size),
+            Stage("mix", self._mix_stage, self.config.pipeline_mix_workers, queue_size),
+            Stage("align", self._align_stage, self.config.pipeline_align_workers, queue_size),
+            Stage("render", self._render_stage, self.workers, queue_size),
+        ], self.config.pipeline_sample_interval)
+        pipeline_results = pipeline.run(PreparedJob(self.build_jobs([video])[0]) for video in videos)
+        try:
+            for pipeline_result in pipeline_results:
+                prepared = pipeline_result.item
+                if prepared.scratch_dir is not None:
+                    shutil.rmtree(prepared.scratch_dir, ignore_errors=True)
+                if pipeline_result.ok:
+                    result = prepared.result
+                else:
+                    result = RenderResult(prepared.job, error=f"{pipeline_result.stage}: {pipeline_result.error}",
+                                          traceback_text=pipeline_result.traceback_text,
+                                          elapsed=time.time() - prepared.start)
+                if not result.skipped:
+                    self._report(result)
+                yield result
+        finally:
+            # Also when the caller stops early, the stage threads stop at their next item
+            pipeline_results.close()
+            self._render_pool.shutdown()
+        pipeline.print_report()
+
+    def _check_stage(self, prepared):
+        # Entries whose inputs did not change since their video was rendered go through the next stages untouched
+        self.hash_inputs([prepared.job])
+        _, up_to_date = self.split_up_to_date([prepared.job])
+        if up_to_date:
+            prepared.result = up_to_date[0]
+        return prepared
+
+    def _tts_stage(self, prepared):
+        if prepared.result is not None:
+            return prepared
+        job = prepared.job
+        prepared.scratch_dir = tempfile.mkdtemp(prefix=f"job_{job.index:05d}_", dir=self.config.audio_dir)
+        if job.entry.script and not job.entry.script.isspace():
+            error = self._prefetcher.fetch(job.entry.script)
+            if error is not None:
+                raise RuntimeError(f"Text to speech failed: {error}")
+            audio_object = _get_tts().get_audio(job.entry.script)
+        else:
+            audio_object = Audio(audio_segment=AudioSegment.silent(duration=40000), scratch_dir=prepared.scratch_dir)
+        prepared.voice_path = audio_object.file_path
+        prepared.voice = audio_object
+        return prepared
+
+    def _mix_stage(self, prepared):
+        if prepared.result is not None:
+            return prepared
+        job = prepared.job
+        audio_object = prepared.voice
+        music_object = None
+        if job.music_path is not None:
+            music_object = MusicCache().get_audio(job.music_path, audio_object.get_sample_rate(), prepared.scratch_dir)
+        video_generator = VideoGeneration(job.media_folder, scratch_dir=prepared.scratch_dir, config=job.config())
+        prepared.audio_path = video_generator.mix_audio(audio_object, music_object).file_path
+        return prepared
+
+    def _align_stage(self, prepared):
+        if prepared.result is not None:
+            return prepared
+        job = prepared.job
+        video_generator = VideoGeneration(job.media_folder, refresh_alignment=job.refresh_alignment,
+                                          config=job.config())
+        prepared.alignment = video_generator.align_script(job.entry.script, prepared.voice)
+        # The render process only needs the paths, the samples are not sent to it
+        prepared.voice = None
+        return prepared
+
+    def _render_stage(self, prepared):
+        if prepared.result is not None:
+            return prepared
+        # A render process that dies breaks the pool and every job running in it: those jobs are rendered again in a
+        # new pool, a job caught in a second crash fails
+        for _ in range(2):
+            pool = self._render_pool
+            try:
+                prepared.result = pool.submit(render_prepared_job, prepared).result()
+                return prepared
+            except BrokenProcessPool:
+                with self._render_pool_lock:
+                    if self._render_pool is pool:
+                        pool.shutdown(wait=False)
+                        self._render_pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_process_context())
+        raise RuntimeError("Worker process died while rendering this entry")
+
+    def _run_pool(self, jobs, results, crashed_once):
+        """
+        Run jobs in a fresh process pool. If a worker process dies, the pool is broken and every unfinished job
+        fails with it: those jobs are returned to be retried in a new pool, except the ones that were already
+        caught in a previous crash, which are reported as failed.
+        """
+        retry = []
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+            futures = {executor.submit(render_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    if job.index in crashed_once:
+                        result = RenderResult(job, error="Worker process died while rendering this entry")
+                    else:
+                        crashed_once.add(job.index)
+                        retry.append(job)
+                        continue
+                results[job.index] = result
+                self._report(result)
+        return sorted(retry, key=lambda j: j.index)
+
+    @staticmethod
+    def _report(result):
+        if result.skipped:
+            print(f"[{result.job.index}] {result.video_path} up to date")
+        elif result.ok:
+            print(f"[{result.job.index}] {result.video_path} rendered in {result.elapsed:.1f}s")
+        else:
+            print(f"[{result.job.index}] {result.job.output_name} failed: {result.error}")
@@ -0,0 +1,119 @@
+import bisect
+
+import numpy as np
+
+
+class Overlay:
+    def __init__(self, index, rgb, alpha, x, y, start, end):
+        self.index = index  # Insertion order, overlays added later are drawn on top
+        self.x = x
+        self.y = y
+        self.start = start
+        self.end = end
+        # Precomputed once for the blend: src * alpha (+127 for rounding) and 255 - alpha
+        alpha = alpha.astype(np.uint16)[:, :, None]
+        self.premultiplied = rgb.astype(np.uint16) * alpha + 127
+        self.inverse_alpha = 255 - alpha
+
+    def is_active(self, t):
+        # Same convention as moviepy's Clip.is_playing
+        return self.start <= t and (self.end is None or t < self.end)
+
+
+class OverlayCompositor:
+    """
+    Draw still overlays (subtitle words, shadows, title backgrounds) on top of a video frame.
+
+    Overlays are kept sorted by start time with the running maximum of their end times, so finding the overlays
+    visible at t is a bisection followed by a backward scan that stops as soon as no earlier overlay can still be
+    visible. They are alpha-blended in place into a preallocated uint8 frame buffer: the cost of a frame depends on
+    the overlays visible at t, not on the total number of overlays.
+    """
+
+    def __init__(self, frame_size):
+        self.frame_size = frame_size
+        self._pending = []
+        self._overlays = []
+        self._starts = []
+        self._max_ends = []
+        self._buffer = None
+
+    def add(self, rgb, alpha, position, start, end):
+        """
+        Add an overlay.
+
+        :param rgb: uint8 array (height, width, 3)
+        :param alpha: uint8 array (height, width)
+        :param position: (x, y) of the top left corner in the frame, can be partly outside the frame
+        :param start: Time at which the overlay appears
+        :param end: Time at which the overlay disappears, None to keep it until the end
+        """
+        width, height = self.frame_size
+        x, y = int(position[0]), int(position[1])
+        # Keep only the part of the overlay that is inside the frame
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + rgb.shape[1], width), min(y + rgb.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        rgb = rgb[y0 - y:y1 - y, x0 - x:x1 - x]
+        alpha = alpha[y0 - y:y1 - y, x0 - x:x1 - x]
+        self._pending.append(Overlay(len(self._pending) + len(self._overlays), rgb, alpha, x0, y0, start, end))
+
+    def add_rect(self, size, color, opacity, position, start, end):
+        """
+        Add a plain colored rectangle, with a constant opacity between 0 and 1.
+        """
+        width, height = size
+        rgb = np.empty((height, width, 3), dtype=np.uint8)
+        rgb[:] = color
+        alpha = np.full((height, width), int(round(opacity * 255)), dtype=np.uint8)
+        self.add(rgb, alpha, position, start, end)
+
+    def _build_index(self):
+        overlays = sorted(self._overlays + self._pending, key=lambda o: (o.start, o.index))
+        self._pending = []
+        self._overlays = overlays
+        self._starts = [o.start for o in overlays]
+        self._max_ends = []
+        max_end = float("-inf")
+        for o in overlays:
+            max_end = float("inf") if o.end is None else max(max_end, o.end)
+            self._max_ends.append(max_end)
+
+    def active(self, t):
+        """
+        Return the overlays visible at t, in drawing order.
+        """
+        if self._pending:
+            self._build_index()
+        active = []
+        i = bisect.bisect_right(self._starts, t) - 1
+        while i >= 0 and self._max_ends[i] > t:
+            if self._overlays[i].is_active(t):
+                active.append(self._overlays[i])
+            i -= 1
+        active.sort(key=lambda o: o.index)
+        return active
+
+    def composite(self, frame, t):
+        """
+        Blend the overlays visible at t on a copy of `frame`.
+
+        :param frame: The background frame, it is not modified
+        :param t: Current time in the video
+        :return: The composited frame, in a buffer reused between calls
+        """
+        active = self.active(t)
+        if not active:
+            return frame
+        if self._buffer is None or self._buffer.shape != frame.shape:
+            self._buffer = np.empty(frame.shape, dtype=np.uint8)
+        np.copyto(self._buffer, frame, casting="unsafe")
+        for overlay in active:
+            height, width = overlay.inverse_alpha.shape[:2]
+            roi = self._buffer[overlay.y:overlay.y + height, overlay.x:overlay.x + width]
+            blended = roi * overlay.inverse_alpha
+            blended += overlay.premultiplied
+            blended //= 255
+            roi[:] = blended
+        return self._buffer
@@ -1,58 +1,251 @@
 import csv
+import json
+import os
+import threading
+from collections import deque
 
-from src.utils import Config
+from src.utils import get_config, atomic_write_json
 
 
 class VideoEntry:
-    def __init__(self, script, title, hashtags, description, filename=None):
+    __slots__ = ("index", "filename", "script", "title", "hashtags", "description", "settings")
+
+    def __init__(self, script, title, hashtags, description, filename=None, settings=None, index=0):
+        self.index = index  # Position of the row in the CSV, the header row excluded
         self.filename = filename
         self.script = script
         self.title = title
         self.hashtags = hashtags
         self.description = description
+        # Settings of this video only: "music" (a file of music_dir) and Config fields, e.g. subtitle_font_size
+        self.settings = settings if settings is not None else {}
+
+
+class RowError:
+    """
+    A row that could not be read, it is skipped and the next rows are read.
+    """
+    __slots__ = ("index", "line", "message")
+
+    def __init__(self, index, line, message):
+        self.index = index  # Position of the row in the CSV, as for VideoEntry.index
+        self.line = line  # Line of the file the row starts on, from 1
+        self.message = message
+
+    def __str__(self):
+        return f"Row {self.index} (line {self.line}): {self.message}"
+
+
+class CSVPosition:
+    """
+    Where the reading of a CSV stopped: the index of the next row, and the byte offset and line it starts at.
+    """
+    __slots__ = ("row", "offset", "line")
+
+    def __init__(self, row=0, offset=0, line=1):
+        self.row = row
+        self.offset = offset
+        self.line = line
+
 
+def parse_settings(text):
+    """
+    :param text: The settings column of a row, a JSON object such as {"subtitle_font_size": 80, "music": "2.mp3"}
+    :return: The settings as a dict, empty for an empty column
+    :raise ValueError: If the column is not a JSON object, or has unknown settings or invalid values
+    """
+    if not text or text.isspace():
+        return {}
+    settings = json.loads(text)
+    if not isinstance(settings, dict):
+        raise ValueError(f"The settings of a row must be a JSON object, got {text}")
+    overrides = dict(settings)
+    music = overrides.pop("music", None)
+    if music is not None and not isinstance(music, str):
+        raise ValueError(f"Invalid music {music!r}, it must be the name of a file of music_dir")
+    try:
+        # The settings are checked when the row is read, so a bad row is skipped before any job is built for it
+        get_config().with_overrides(overrides)
+    except KeyError as e:
+        raise ValueError(e.args[0])
+    return settings
+
+
+def parse_row(row, index):
+    """
+    :param row: The fields of a row: [filename,] script, title, hashtags, description[, settings]
+    :return: The VideoEntry of the row
+    :raise ValueError: If the row has the wrong number of columns, invalid settings or bytes that are not UTF-8
+    """
+    try:
+        for field in row:
+            # Bytes that are not UTF-8 were decoded as surrogates, which cannot be encoded back
+            field.encode("utf-8")
+    except UnicodeEncodeError:
+        raise ValueError("The row is not valid UTF-8")
+    settings = None
+    if len(row) == 4:
+        script, video_title, hashtags, video_description = row
+        filename = None
+    elif len(row) == 5:
+        filename, script, video_title, hashtags, video_description = row
+    elif len(row) == 6:
+        filename, script, video_title, hashtags, video_description, settings = row
+        filename = filename or None
+    else:
+        raise ValueError(f"Expected 4 to 6 columns, got {len(row)}")
+    return VideoEntry(script, video_title, hashtags, video_description, filename, parse_settings(settings), index)
 
 
 class CSVReader:
+    """
+    Reads the video entries of a CSV one row at a time, so the memory used does not depend on the size of the file.
+    Rows that cannot be read are skipped and recorded in `errors`. After each entry, `position` is where the next
+    row starts: saved in a CSVCheckpoint, it lets a later run resume from that row without reading the ones before.
+    """
+
     def __init__(self, csv_path=None):
-        config = Config()  # Instantiate Config to get settings
+        config = get_config()  # Settings of the process, read once
         self.file_path = config.csv_path if csv_path is None else csv_path
         self.is_header_row = config.is_header_row
-        self.video_entries = []
-        self.read_csv()
+        self.errors = []
+        self.position = CSVPosition()
 
-    def read_csv(self):
+    def iter_entries(self, start=None):
         """
-        Reads a CSV file and populates the video_entries attribute with VideoEntry objects.
+        :param start: The CSVPosition to resume from, the start of the file if None
+        :return: A generator of the VideoEntry of the rows
         """
+        start = start if start is not None else CSVPosition()
+        self.position = CSVPosition(start.row, start.offset, start.line)
         try:
-            with open(self.file_path, mode='r', encoding='utf-8') as file:
-                csv_read = csv.reader(file)
-                if self.is_header_row:
-                    next(csv_read)  # Skip the header row
+            with open(self.file_path, mode='rb') as file:
+                file.seek(start.offset)
+                # Lines are read one at a time with readline, so tell() is where the row that was just parsed ends
+                lines = (line.decode('utf-8', errors='surrogateescape') for line in iter(file.readline, b''))
+                csv_read = csv.reader(lines)
+                if self.is_header_row and start.offset == 0:
+                    next(csv_read, None)  # Skip the header row
+                    self.position.offset = file.tell()
+                    self.position.line = start.line + csv_read.line_num
 
-                for row in csv_read:
-                    if len(row) == 4:
-                        script, video_title, hashtags, video_description = row
-                        filename = None
-                    elif len(row) == 5:
-                        filename, script, video_title, hashtags, video_description = row
-
-                    video_entry = VideoEntry(script, video_title, hashtags, video_description, filename)
-                    self.video_entries.append(video_entry)
+                while True:
+                    index, line = self.position.row, self.position.line
+                    try:
+                        row = next(csv_read)
+                    except StopIteration:
+                        return
+                    except csv.Error as e:
+                        row = None
+                        error = str(e)
+                    self.position = CSVPosition(index + 1, file.tell(), start.line + csv_read.line_num)
+                    if row is not None:
+                        if not row:
+                            # A blank line is not a row
+                            self.position.row = index
+                            continue
+                        try:
+                            entry = parse_row(row, index)
+                        except ValueError as e:
+                            error = str(e)
+                        else:
+                            yield entry
+                            continue
+                    self.errors.append(RowError(index, line, error))
 
         except FileNotFoundError:
             print(f"File {self.file_path} not found.")
-        except Exception as e:
-            print(f"An error occurred while reading the CSV file: {e}")
 
     def get_video_entries(self):
-        return self.video_entries
+        """
+        :return: The list of all the entries, see iter_entries to read large files
+        """
+        return list(self.iter_entries())
+
+
+class CSVProgress:
+    """
+    The position to save in a CSVCheckpoint when entries complete out of order, e.g. in a pipeline: the position after
+    the last entry of the longest run of completed entries from the start, so a resumed run skips no entry that was
+    not completed.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.pending = deque()  # Indexes of the entries read and not saved yet, in reading order
+        self.positions = {}  # Position after each entry of pending
+        self.completed = set()
+
+    def track(self, entries):
+        """
+        :param entries: The generator of VideoEntry of the reader, e.g. reader.iter_entries()
+        :return: The same entries, with the position after each one recorded
+        """
+        for entry in entries:
+            with self.lock:
+                self.pending.append(entry.index)
+                self.positions[entry.index] = self.reader.position
+            yield entry
+
+    def complete(self, index):
+        """
+        :param index: VideoEntry.index of an entry that completed
+        :return: The CSVPosition to save, or None if it did not move
+        """
+        position = None
+        with self.lock:
+            self.completed.add(index)
+            while self.pending and self.pending[0] in self.completed:
+                first = self.pending.popleft()
+                self.completed.discard(first)
+                position = self.positions.pop(first)
+        return position
+
+
+class CSVCheckpoint:
+    """
+    The position reached in a CSV, saved in <csv>.checkpoint.json. It is only used while the CSV has the same size
+    and modification time, an edited file is read from the start again.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.path = os.path.splitext(csv_path)[0] + ".checkpoint.json"
+
+    def _signature(self):
+        stat = os.stat(self.csv_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self):
+        """
+        :return: The saved CSVPosition, or None if there is none for the current content of the CSV
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved["csv"] != self._signature():
+                print(f"{self.csv_path} changed since the checkpoint, reading it from the start.")
+                return None
+            return CSVPosition(saved["row"], saved["offset"], saved["line"])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def save(self, position):
+        atomic_write_json(self.path, {"csv": self._signature(), "row": position.row, "offset": position.offset,
+                                      "line": position.line})
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 
 if __name__ == '__main__':
     csv_reader = CSVReader()
-    video_entries = csv_reader.get_video_entries()
 
-    for entry in video_entries:
+    for entry in csv_reader.iter_entries():
         print(f"Script: {entry.script}, Title: {entry.title}, Description: {entry.description}")
+    for error in csv_reader.errors:
+        print(error)
@@ -0,0 +1,216 @@
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+from moviepy.config import get_setting
+
+from src import tracing
+from src.utils import get_config
+
+
+class EncoderProfile:
+    """
+    Output settings of the encoder, read from the "encoding" profiles of settings.json.
+    Either `crf` (constant quality) or `bitrate` is used, crf takes precedence. A null fps uses the video fps.
+    """
+
+    def __init__(self, codec="libx264", preset="veryfast", crf=23, bitrate=None, fps=None, pixel_format="yuv420p",
+                 audio_codec="aac", audio_bitrate="192k"):
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.bitrate = bitrate
+        self.fps = fps
+        self.pixel_format = pixel_format
+        self.audio_codec = audio_codec
+        self.audio_bitrate = audio_bitrate
+
+    @classmethod
+    def from_config(cls, config=None, name=None):
+        config = config if config is not None else get_config()
+        name = name if name is not None else config.encoding_profile
+        if name not in config.encoding_profiles:
+            raise ValueError(f"Unknown encoding profile {name}, available: {', '.join(config.encoding_profiles)}")
+        settings = config.encoding_profiles[name]
+        return cls(**{key: value for key, value in settings.items() if not key.startswith("_")})
+
+    def video_args(self):
+        args = ["-c:v", self.codec]
+        if self.preset:
+            args += ["-preset", self.preset]
+        if self.crf is not None:
+            args += ["-crf", str(self.crf)]
+        elif self.bitrate:
+            args += ["-b:v", self.bitrate]
+        return args + ["-pix_fmt", self.pixel_format]
+
+    def audio_args(self):
+        args = ["-c:a", self.audio_codec]
+        if self.audio_bitrate:
+            args += ["-b:a", self.audio_bitrate]
+        return args
+
+
+class StreamingEncoder:
+    """
+    Encode a clip by streaming raw RGB frames into a single ffmpeg process.
+
+    Frames are produced in the calling thread and handed through a bounded queue to a writer thread feeding ffmpeg's
+    stdin, so computing the next frames in Python overlaps with x264 encoding the previous ones, while the queue
+    bounds the memory used by frames waiting to be encoded.
+    """
+
+    def __init__(self, output_path, frame_size, fps, profile=None, audio_path=None, queue_size=16):
+        self.output_path = output_path
+        self.frame_size = tuple(frame_size)
+        self.fps = fps
+        self.profile = profile if profile is not None else EncoderProfile()
+        self.audio_path = audio_path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+
+    def ffmpeg_command(self, output_path=None):
+        width, height = self.frame_size
+        command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-vcodec", "rawvideo", "-s", f"{width}x{height}", "-pix_fmt", "rgb24",
+                   "-r", f"{self.fps}", "-i", "-"]
+        if self.audio_path is not None:
+            command += ["-i", self.audio_path, "-map", "0:v", "-map", "1:a"]
+        command += self.profile.video_args()
+        if self.audio_path is not None:
+            command += self.profile.audio_args() + ["-shortest"]
+        return command + [output_path if output_path is not None else self.output_path]
+
+    def encode(self, clip, duration=None, start_frame=0, end_frame=None):
+        """
+        Encode the frames of `clip` from 0 to `duration` (the clip duration by default), or only the frames from
+        `start_frame` to `end_frame` to render a segment of the clip.
+
+        :param clip: A clip whose frames have the encoder frame size
+        :param duration: Duration to encode, in seconds
+        :param start_frame: Index of the first frame to encode
+        :param end_frame: Index after the last frame to encode, defaults to the last frame of `duration`
+        :return: The output path
+        """
+        duration = duration if duration is not None else clip.duration
+        end_frame = end_frame if end_frame is not None else int(duration * self.fps)
+        # ffmpeg writes a partial file that replaces the output once the encoding succeeded, so a failed encoding
+        # never leaves a truncated video at the output path
+        partial_path = _partial_path(self.output_path)
+        produced = succeeded = False
+        with tempfile.TemporaryFile() as log:
+            process = subprocess.Popen(self.ffmpeg_command(partial_path), stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=log)
+            writer = threading.Thread(target=self._write_frames, args=(process.stdin,), daemon=True)
+            writer.start()
+            try:
+                get_frame = tracing.frame_timer("frame", clip.get_frame)
+                for i in range(start_frame, end_frame):
+                    if not self._put(self._frame_bytes(get_frame(i / self.fps))):
+                        break
+                produced = True
+            finally:
+                if not produced:
+                    # Producing a frame failed: closing stdin would make ffmpeg finalize the frames so far
+                    process.kill()
+                # Always stop the writer, also when producing a frame failed
+                self._put(None)
+                writer.join()
+                try:
+                    process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+                return_code = process.wait()
+                succeeded = produced and self._error is None and return_code == 0
+                if succeeded:
+                    os.replace(partial_path, self.output_path)
+                else:
+                    _remove(partial_path)
+            if not succeeded:
+                log.seek(0)
+                message = log.read().decode(errors="replace").strip()
+                raise RuntimeError(f"ffmpeg failed to encode {self.output_path}: {message or self._error}")
+        return self.output_path
+
+    def _frame_bytes(self, frame):
+        width, height = self.frame_size
+        if frame.shape[:2] != (height, width):
+            raise ValueError(f"Frame of size {frame.shape[1]}x{frame.shape[0]} given to an encoder of size "
+                             f"{width}x{height}")
+        # tobytes copies the frame, so frame buffers reused by the clips can be overwritten right away
+        return np.ascontiguousarray(frame[:, :, :3], dtype=np.uint8).tobytes()
+
+    def _put(self, item):
+        """
+        Queue an item for the writer thread, return False if the writer stopped because ffmpeg failed.
+        """
+        while self._error is None:
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _write_frames(self, stdin):
+        # Time spent waiting for ffmpeg to take the frame, high when the encoder is the bottleneck
+        write = tracing.frame_timer("encoder.write", stdin.write)
+        try:
+            while (frame := self._queue.get()) is not None:
+                write(frame)
+        except (BrokenPipeError, OSError) as e:
+            self._error = e
+
+
+def concat_segments(segment_paths, output_path, audio_path=None, profile=None):
+    """
+    Join video segments encoded with the same settings with ffmpeg's concat demuxer, without encoding the video again,
+    and add the audio track.
+
+    :param segment_paths: The segments, in order
+    :param output_path: Path of the joined video
+    :param audio_path: Audio of the whole video, encoded with the audio settings of `profile`
+    :param profile: The EncoderProfile of the segments
+    :return: The output path
+    """
+    profile = profile if profile is not None else EncoderProfile()
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", dir=os.path.dirname(os.path.abspath(segment_paths[0])),
+                                     delete=False) as list_file:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+    try:
+        command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                   "-i", list_file.name]
+        if audio_path is not None:
+            command += ["-i", audio_path, "-map", "0:v", "-map", "1:a", "-c:v", "copy"] + profile.audio_args()
+            command += ["-shortest"]
+        else:
+            command += ["-c:v", "copy"]
+        partial_path = _partial_path(output_path)
+        process = subprocess.run(command + ["-movflags", "+faststart", partial_path], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            _remove(partial_path)
+            raise RuntimeError(f"ffmpeg failed to join the segments of {output_path}: "
+                               f"{process.stderr.decode(errors='replace').strip()}")
+        os.replace(partial_path, output_path)
+    finally:
+        os.remove(list_file.name)
+    return output_path
+
+
+def _partial_path(output_path):
+    # Same folder so that os.replace is atomic, same extension so that ffmpeg picks the same container
+    base, extension = os.path.splitext(output_path)
+    return f"{base}.partial_{os.getpid()}{extension}"
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import time
+import traceback
+from collections import Counter
+
+from pydub import AudioSegment
+
+from src import tracing
+from src.batch_renderer import BatchRenderer, RenderResult, _get_tts
+from src.job_store import JobStore
+from src.music_cache import MusicCache
+from src.render_manifest import RenderManifest
+from src.text_to_speech import TTSPrefetcher
+from src.utils import Audio, atomic_write_json
+from src.video_generator import VideoGeneration
+
+# One TTSPrefetcher per worker process, so its rate limit applies to all the jobs of the process
+_worker_prefetcher = None
+
+
+def _get_prefetcher():
+    global _worker_prefetcher
+    if _worker_prefetcher is None:
+        _worker_prefetcher = TTSPrefetcher(tts=_get_tts())
+    return _worker_prefetcher
+
+
+class _Stage:
+    """
+    Times a stage and records it in the store once it completed.
+    """
+
+    def __init__(self, store, stored_job, name):
+        self.store = store
+        self.stored_job = stored_job
+        self.name = name
+        self.artifact = None
+        self.start = 0.0
+        self.span = tracing.span(name)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            self.store.complete_stage(self.stored_job, self.name, self.artifact, time.time() - self.start)
+        return False
+
+
+def run_stored_job(store, stored_job, renderer, upload=False):
+    """
+    Run the stages of a claimed job that it did not complete yet, recording each one in the store as soon as it is
+    done. The voice, the mixed audio and the alignment are kept in a folder of the job until the job is done, so a job
+    interrupted in a later stage does not compute them again.
+
+    :param store: The JobStore the job was claimed from
+    :param stored_job: The StoredJob
+    :param renderer: A BatchRenderer with the render options, it names the job and checks its manifest
+    :param upload: Run the upload stage after the render
+    :return: A RenderResult
+    """
+    start = time.time()
+    # The output name was chosen from the names of the whole CSV when the job was queued
+    output_names = [stored_job.output_name] if stored_job.output_name is not None else None
+    job = renderer.build_jobs([stored_job.entry], output_names)[0]
+    try:
+        with tracing.span("stored_job", index=job.index, output=job.output_name, stage=stored_job.stage):
+            config = job.config()
+            job_dir = os.path.join(config.audio_dir, "jobs", f"{stored_job.csv_name}_{stored_job.row:05d}")
+            os.makedirs(job_dir, exist_ok=True)
+            video_generator = VideoGeneration(job.media_folder, scratch_dir=job_dir,
+                                              refresh_alignment=job.refresh_alignment, config=config)
+            skipped = False
+
+            if not stored_job.is_completed("render"):
+                # A video up to date with its inputs goes straight to the upload
+                renderer.hash_inputs([job])
+                _, up_to_date = renderer.split_up_to_date([job])
+                if up_to_date:
+                    skipped = True
+                    store.complete_stage(stored_job, "render", job.video_path)
+
+            if not stored_job.is_completed("render"):
+                video_path = _render(store, stored_job, job, video_generator, job_dir)
+            else:
+                video_path = stored_job.artifacts.get("render", job.video_path)
+
+            if upload and not stored_job.is_completed("upload"):
+                with _Stage(store, stored_job, "upload"):
+                    # Imported here, uploading needs the selenium and Google API packages
+                    from src.uploader import Uploader
+                    Uploader(job.entry, file_path=video_path).upload_to_all()
+
+            store.finish(stored_job)
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return RenderResult(job, video_path=video_path, elapsed=time.time() - start, skipped=skipped)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        store.fail(stored_job, error)
+        return RenderResult(job, error=error, traceback_text=traceback.format_exc(), elapsed=time.time() - start)
+
+
+def _render(store, stored_job, job, video_generator, job_dir):
+    """
+    Run the tts, mix, align and render stages that the job did not complete.
+
+    :return: The path of the video
+    """
+    video = job.entry
+    if stored_job.is_completed("tts"):
+        audio_object = Audio(stored_job.artifacts["tts"])
+    else:
+        with _Stage(store, stored_job, "tts") as stage:
+            if video.script and not video.script.isspace():
+                failures = _get_prefetcher().prefetch([video.script])
+                if failures:
+                    raise RuntimeError(f"Text to speech failed: {failures[video.script]}")
+                audio_object = _get_tts().get_audio(video.script)
+            else:
+                audio_object = Audio(audio_segment=AudioSegment.silent(duration=40000), scratch_dir=job_dir)
+            stage.artifact = audio_object.file_path
+
+    if stored_job.is_completed("mix"):
+        video_audio = Audio(stored_job.artifacts["mix"])
+    else:
+        with _Stage(store, stored_job, "mix") as stage:
+            music_object = None
+            if job.music_path is not None:
+                music_object = MusicCache().get_audio(job.music_path, audio_object.get_sample_rate(), job_dir)
+            video_audio = video_generator.mix_audio(audio_object, music_object)
+            stage.artifact = video_audio.file_path
+
+    if stored_job.is_completed("align"):
+        with open(stored_job.artifacts["align"], "r", encoding="utf-8") as f:
+            alignment = json.load(f)
+    else:
+        with _Stage(store, stored_job, "align") as stage:
+            alignment = video_generator.align_script(video.script, audio_object)
+            stage.artifact = os.path.join(job_dir, "alignment.json")
+            atomic_write_json(stage.artifact, alignment)
+
+    with _Stage(store, stored_job, "render") as stage:
+        manifest = RenderManifest(job.config())
+        manifest.remove(job.video_path)
+        video_path = video_generator.generate_video(audio_object, video.script, video.title, job.output_name,
+                                                    draft=job.draft, segments=job.segments, video_audio=video_audio,
+                                                    alignment=alignment)
+        if job.input_digest is not None:
+            manifest.write(video_path, job.input_digest, job.inputs)
+        stage.artifact = video_path
+    return video_path
+
+
+def store_worker(store_path, csv_name, draft=False, refresh_alignment=False, force=False, segments=None,
+                 upload=False):
+    """
+    Claim the jobs of a CSV from the store and run them until none is left. Several workers, in this process, in
+    other processes or in other runs, can work on the same store.
+
+    :return: The number of jobs rendered, skipped (up to date) and failed by this worker
+    """
+    store = JobStore(store_path)
+    renderer = BatchRenderer(csv_name, refresh_alignment=refresh_alignment, draft=draft, force=force,
+                             segments=segments)
+    counts = Counter()
+    try:
+        while (stored_job := store.claim(csv_name=csv_name)) is not None:
+            result = run_stored_job(store, stored_job, renderer, upload)
+            BatchRenderer._report(result)
+            counts["skipped" if result.skipped else "rendered" if result.ok else "failed"] += 1
+    finally:
+        store.close()
+        # Worker processes exit without running atexit handlers
+        tracing.flush()
+        if _worker_prefetcher is not None:
+            _worker_prefetcher.tts.cache.flush()
+    return counts
@@ -0,0 +1,320 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from src.csv_reader import VideoEntry
+from src.utils import get_config
+
+# Stages of a job, in order. The stage of a job is the last one it completed
+STAGES = ("tts", "mix", "align", "render", "upload")
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    csv TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    stage TEXT,
+    artifacts TEXT NOT NULL DEFAULT '{}',
+    worker TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    output_name TEXT,
+    UNIQUE (csv, row)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS stage_events (
+    job_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    worker TEXT,
+    duration REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_events_finished ON stage_events (finished_at);
+"""
+
+JOB_COLUMNS = "id, csv, row, entry, status, stage, artifacts, attempts, error, output_name"
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def entry_to_json(entry):
+    return json.dumps({"filename": entry.filename, "script": entry.script, "title": entry.title,
+                       "hashtags": entry.hashtags, "description": entry.description, "settings": entry.settings},
+                      sort_keys=True)
+
+
+class StoredJob:
+    def __init__(self, job_id, csv_name, row, entry, status, stage, artifacts, attempts, error=None, output_name=None):
+        self.id = job_id
+        self.csv_name = csv_name
+        self.row = row  # VideoEntry.index of the row in its CSV
+        self.entry = entry
+        # Name of the video, chosen when the row was queued from the names of the whole CSV
+        self.output_name = output_name
+        self.status = status
+        self.stage = stage  # Last completed stage, None if none
+        self.artifacts = artifacts  # Path of the output of each completed stage
+        self.attempts = attempts
+        self.error = error
+
+    @classmethod
+    def from_row(cls, row):
+        job_id, csv_name, index, entry, status, stage, artifacts, attempts, error, output_name = row
+        entry = json.loads(entry)
+        return cls(job_id, csv_name, index, VideoEntry(entry["script"], entry["title"], entry["hashtags"],
+                                                       entry["description"], entry["filename"], entry["settings"],
+                                                       index),
+                   status, stage, json.loads(artifacts), attempts, error, output_name)
+
+    def is_completed(self, stage):
+        """
+        :return: True if the job completed `stage` and its artifact, when it has one, is still on disk
+        """
+        if self.stage is None or STAGES.index(self.stage) < STAGES.index(stage):
+            return False
+        path = self.artifacts.get(stage)
+        return path is None or os.path.exists(path)
+
+
+class JobStore:
+    """
+    The progress of every CSV row through the STAGES, in an SQLite database in WAL mode so that worker processes,
+    of this run or of other runs, claim jobs and record their progress concurrently. A stage is recorded as soon
+    as it completes, with the path of what it produced, so a job interrupted at any point resumes from its last
+    completed stage.
+
+    Claiming happens in an immediate transaction, so a job is given to one worker only. A job stays claimed while its
+    worker records stages, a job that was not updated for lease_seconds, or whose worker process on this host is
+    gone, is given to another worker.
+    """
+
+    def __init__(self, path=None, lease_seconds=None):
+        config = get_config()
+        self.path = path if path is not None else config.job_store_path
+        self.lease_seconds = lease_seconds if lease_seconds is not None else config.job_store_lease
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # SQLite connections must not be shared with forked processes, each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            columns = [column[1] for column in connection.execute("PRAGMA table_info(jobs)")]
+            if "output_name" not in columns:
+                # Store created before the output names were recorded
+                connection.execute("ALTER TABLE jobs ADD COLUMN output_name TEXT")
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at once, so two workers never read the same pending job
+        return _Transaction(self.connection)
+
+    def enqueue(self, csv_name, entries, output_name=None):
+        """
+        Add the entries of a CSV that are not in the store. An entry whose content or output name changed since it
+        was added is started again from the first stage, the others keep their progress.
+
+        :param entries: Iterable of VideoEntry, read in batches so any number of rows can be added
+        :param output_name: Function giving the name of the video of an entry, chosen from the names of the whole CSV
+            (see BatchRenderer.output_name) so that two rows never render to the same file
+        :return: The number of jobs added or started again
+        """
+        changed = 0
+        batch = []
+        for entry in entries:
+            name = output_name(entry) if output_name is not None else None
+            batch.append((csv_name, entry.index, entry_to_json(entry), time.time(), name))
+            if len(batch) == 500:
+                changed += self._insert(batch)
+                batch = []
+        if batch:
+            changed += self._insert(batch)
+        return changed
+
+    def _insert(self, batch):
+        with self._transaction() as connection:
+            # Jobs queued before the output names were recorded keep their progress
+            connection.executemany("UPDATE jobs SET output_name = ? WHERE csv = ? AND row = ? AND output_name IS NULL",
+                                   [(name, csv_name, row) for csv_name, row, _, _, name in batch])
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT INTO jobs (csv, row, entry, updated_at, output_name) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (csv, row) DO UPDATE SET entry = excluded.entry, status = 'pending', stage = NULL, "
+                "artifacts = '{}', worker = NULL, attempts = 0, error = NULL, updated_at = excluded.updated_at, "
+                "output_name = excluded.output_name "
+                "WHERE jobs.entry != excluded.entry OR jobs.output_name IS NOT excluded.output_name", batch)
+            return connection.total_changes - before
+
+    def requeue_dead_workers(self):
+        """
+        Give back the jobs claimed by worker processes of this host that no longer exist.
+
+        :return: The number of jobs given back
+        """
+        host = socket.gethostname()
+        requeued = 0
+        with self._transaction() as connection:
+            running = connection.execute("SELECT id, worker FROM jobs WHERE status = ? AND worker LIKE ?",
+                                         (RUNNING, host + ":%")).fetchall()
+            for job_id, worker in running:
+                if not _process_exists(int(worker.rsplit(":", 1)[1])):
+                    connection.execute("UPDATE jobs SET status = ?, worker = NULL WHERE id = ?", (PENDING, job_id))
+                    requeued += 1
+        return requeued
+
+    def claim(self, worker=None, csv_name=None):
+        """
+        :param worker: Name of the claiming worker, host:pid of this process by default
+        :param csv_name: Only claim the jobs of this CSV
+        :return: The StoredJob now claimed by the worker, or None when there is no job left to claim
+        """
+        worker = worker if worker is not None else worker_name()
+        now = time.time()
+        query = f"SELECT {JOB_COLUMNS} FROM jobs WHERE (status = ? OR (status = ? AND claimed_at < ?))"
+        params = [PENDING, RUNNING, now - self.lease_seconds]
+        if csv_name is not None:
+            query += " AND csv = ?"
+            params.append(csv_name)
+        with self._transaction() as connection:
+            row = connection.execute(query + " ORDER BY id LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            job = StoredJob.from_row(row)
+            connection.execute("UPDATE jobs SET status = ?, worker = ?, claimed_at = ?, attempts = attempts + 1, "
+                               "updated_at = ? WHERE id = ?", (RUNNING, worker, now, now, job.id))
+        job.status = RUNNING
+        job.attempts += 1
+        return job
+
+    def complete_stage(self, job, stage, artifact=None, duration=0.0, worker=None):
+        """
+        Record that the job completed `stage`, which also renews the claim of the worker on the job.
+
+        :param artifact: Path of what the stage produced, checked before the stage is skipped on resume
+        """
+        now = time.time()
+        job.stage = stage
+        if artifact is not None:
+            job.artifacts[stage] = artifact
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET stage = ?, artifacts = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                               (stage, json.dumps(job.artifacts), now, now, job.id))
+            connection.execute("INSERT INTO stage_events VALUES (?, ?, ?, ?, ?)",
+                               (job.id, stage, worker if worker is not None else worker_name(), duration, now))
+
+    def finish(self, job):
+        self._set_status(job, DONE)
+
+    def fail(self, job, error):
+        self._set_status(job, FAILED, error)
+
+    def _set_status(self, job, status, error=None):
+        job.status, job.error = status, error
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET status = ?, error = ?, worker = NULL, updated_at = ? WHERE id = ?",
+                               (status, error, time.time(), job.id))
+
+    def retry_failed(self, csv_name=None):
+        """
+        Give the failed jobs to the workers again, they resume from their last completed stage.
+
+        :return: The number of jobs given back
+        """
+        query, params = "UPDATE jobs SET status = ?, error = NULL WHERE status = ?", [PENDING, FAILED]
+        if csv_name is not None:
+            query += " AND csv = ?"
+            params.append(csv_name)
+        with self._transaction() as connection:
+            return connection.execute(query, params).rowcount
+
+    def failures(self, csv_name=None):
+        """
+        :return: The failed StoredJob, in row order
+        """
+        query = f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = ?"
+        params = [FAILED]
+        if csv_name is not None:
+            query += " AND csv = ?"
+            params.append(csv_name)
+        return [StoredJob.from_row(row) for row in self.connection.execute(query + " ORDER BY csv, row", params)]
+
+    def status(self, csv_name=None, window=600):
+        """
+        :param window: Seconds of recent activity the throughput is measured on
+        :return: A dict with the number of jobs per status and per last completed stage, the queue depth, and for
+            each stage the number of jobs that completed it in the last `window` seconds and their mean duration
+        """
+        where, params = ("WHERE csv = ?", [csv_name]) if csv_name is not None else ("", [])
+        connection = self.connection
+        statuses = dict(connection.execute(f"SELECT status, COUNT(*) FROM jobs {where} GROUP BY status", params))
+        stages = dict(connection.execute(f"SELECT COALESCE(stage, 'none'), COUNT(*) FROM jobs {where} "
+                                         f"GROUP BY stage", params))
+        event_where = "WHERE e.finished_at >= ?" + (" AND j.csv = ?" if csv_name is not None else "")
+        recent = connection.execute(f"SELECT e.stage, COUNT(*), AVG(e.duration) FROM stage_events e "
+                                    f"JOIN jobs j ON j.id = e.job_id {event_where} GROUP BY e.stage",
+                                    [time.time() - window] + params).fetchall()
+        return {
+            "jobs": sum(statuses.values()),
+            "statuses": {status: statuses.get(status, 0) for status in (PENDING, RUNNING, DONE, FAILED)},
+            "stages": {stage: stages.get(stage, 0) for stage in ("none",) + STAGES},
+            "queue_depth": statuses.get(PENDING, 0) + statuses.get(RUNNING, 0),
+            "window": window,
+            "throughput": {stage: {"per_minute": count * 60 / window, "mean_duration": mean}
+                           for stage, count, mean in sorted(recent, key=lambda r: STAGES.index(r[0]))},
+        }
+
+    def print_status(self, csv_name=None, window=600):
+        status = self.status(csv_name, window)
+        statuses = ", ".join(f"{count} {name}" for name, count in status["statuses"].items())
+        print(f"{self.path}: {status['jobs']} jobs{f' of {csv_name}' if csv_name else ''} ({statuses}), "
+              f"queue depth {status['queue_depth']}")
+        print("Last completed stage: " + ", ".join(f"{stage} {count}" for stage, count in status["stages"].items()))
+        if not status["throughput"]:
+            print(f"No stage completed in the last {window // 60} minutes")
+        for stage, stats in status["throughput"].items():
+            print(f"{stage}: {stats['per_minute']:.2f} jobs/min over the last {window // 60} minutes, "
+                  f"{stats['mean_duration']:.1f}s per job")
+
+
+class _Transaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
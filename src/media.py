@@ -1,34 +1,59 @@
 import os
 
 import cv2
+import numpy as np
 from moviepy import Clip
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
 from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.video.VideoClip import ImageClip, VideoClip
 
-from src.utils import Config
+from src import tracing
+from src.proxy_cache import ProxyCache
+from src.utils import get_config
 
 
 class Media:
-    def __init__(self, path: str, media_duration, clip: Clip = None):
+    def __init__(self, path: str, media_duration, clip: Clip = None, options=None, frame_size=None, fps=None,
+                 config=None):
         self.path = path
-        config = Config()
-        self.final_clip_frame_size = config.frame_size
-        self.fps = config.fps
+        # Options of the file name (start, crop, zoom, shift), parsed from the path when not given by a MediaIndex
+        self.options = options if options is not None else parse_filename(path)
+        config = config if config is not None else get_config()
+        self.config = config
+        # Size and fps of the video being rendered, smaller than the configured ones for drafts
+        self.final_clip_frame_size = tuple(frame_size) if frame_size is not None else config.frame_size
+        self.fps = fps if fps is not None else config.fps
         self.clip = clip
+        self.is_video = path.lower().endswith(('.mp4', '.avi', '.mov'))
+        # Still images are decoded and fitted to the frame once, only the shift/zoom is computed per frame
+        self.is_still = False
+        self.image = None
+        self.base_frame = None
+        # Trim, crop/pad, shift and zoom are not applied one after the other on every frame: they are
+        # composed into a single affine matrix per timestamp and applied with one cv2.warpAffine
+        self.fit = "pad"
+        self.max_shift_factor = 0
+        self.max_zoom_factor = 1
+        self.ken_burns = False
+        self._fit_matrices = {}
+        self._frame_buffer = None
         if clip is None:
             self._load_media()
         self._process_from_name(media_duration)
 
     def _load_media(self):
-        if self.path.lower().endswith(('.mp4', '.avi', '.mov')):
-            self.clip = VideoFileClip(self.path)
+        if self.is_video:
+            # A proxy at the output size is decoded instead of the source when proxies are enabled
+            source_path = ProxyCache(config=self.config).get(self.path, self.final_clip_frame_size, self.fps)
+            self.clip = VideoFileClip(source_path)
             self.clip = self.clip.without_audio()
         else:
-            self.clip = ImageSequenceClip([self.path], fps=self.fps)
+            self.image = load_image(self.path)
+            self.is_still = True
+            self.clip = ImageClip(self.image)
 
     def _process_from_name(self, media_duration):
-        info = parse_filename(self.path)
-        if "start" in info and is_float(info["start"]):
+        info = self.options
+        if not self.is_still and "start" in info and is_float(info["start"]):
             if (start := float(info["start"])) < self.get_duration():
                 self.trim(start)
 
@@ -47,18 +72,26 @@ class Media:
             shift = False
         if zoom or shift:
             self.shift_and_zoom(zoom, shift)
+        if self.is_still:
+            self._build_still_clip()
+        else:
+            self._apply_geometry()
 
     def set_duration(self, duration: float):
         # Do the required processing here
-        if isinstance(self.clip, VideoFileClip):
+        if self.is_video:
             self.clip = self.clip.set_duration(min(duration, self.clip.duration))
         else:
             self.clip = self.clip.set_duration(duration)
 
     def shift_and_zoom(self, zoom=True, shift=True):
+        """
+        Enable the shift and zoom (Ken Burns) effect. It is folded into the geometry applied by _apply_geometry.
+        """
         clip_width, clip_height = self.final_clip_frame_size
-        frame_width, frame_height = self.clip.size
-        max_shift_factor = 0.15 if shift else 0
+        # The fitted frame always has the final frame size
+        frame_width, frame_height = self.final_clip_frame_size
+        self.max_shift_factor = 0.15 if shift else 0
 
         target_aspect_ratio = frame_width / frame_height
         current_aspect_ratio = clip_width / clip_height
@@ -70,13 +103,8 @@ class Media:
             final_width_frame = int(clip_height / target_aspect_ratio)
             height_ratio = 1.1 * final_width_frame / clip_width
 
-        height_ratio = height_ratio if zoom else 1
-        self.clip = self.clip.fl(
-            lambda gf, t: shift_and_zoom(gf,
-                                         t,
-                                         max_shift_factor=max_shift_factor,
-                                         max_zoom_factor=height_ratio,
-                                         duration=self.get_duration() * 1.2))
+        self.max_zoom_factor = height_ratio if zoom else 1
+        self.ken_burns = True
 
     def add_transition(self, transition_type: str, fade_duration: float):
         # Add fade transition here
@@ -86,50 +114,67 @@ class Media:
             self.clip = self.clip.crossfadein(fade_duration)
 
     def pad_to_aspect_ratio(self):
-        # Pad the video to a specific aspect ratio
-        self.clip = pad_video_to_aspect_ratio(self.clip,
-                                              self.final_clip_frame_size[0],
-                                              self.final_clip_frame_size[1])
+        # Pad the video to a specific aspect ratio, applied by _apply_geometry
+        self.fit = "pad"
+        self._fit_matrices = {}
 
     def crop_to_aspect_ratio(self):
         """
-        Crop the clip to a specific aspect ratio by resizing and then cropping equally from the center.
-
-        Parameters:
-        - target_width: The target width
-        - target_height: The target height
-
-        Returns:
-        - A new VideoFileClip that has been cropped
+        Crop the clip to the frame aspect ratio by resizing and then cropping equally from the center.
+        The crop is applied by _apply_geometry.
         """
-        target_width, target_height = self.final_clip_frame_size
-        target_aspect_ratio = target_width / target_height
-        clip_aspect_ratio = self.clip.size[0] / self.clip.size[1]
-
-        # Decide which dimension to match first (width or height) based on aspect ratio
-        if clip_aspect_ratio > target_aspect_ratio:
-            # Clip is too wide, match the height first
-            new_height = target_height
-            new_width = int(target_height * clip_aspect_ratio)
+        self.fit = "crop"
+        self._fit_matrices = {}
+
+    def _fit_matrix(self, source_width, source_height):
+        key = (source_width, source_height)
+        if key not in self._fit_matrices:
+            target_width, target_height = self.final_clip_frame_size
+            if self.fit == "crop":
+                matrix = crop_matrix(source_width, source_height, target_width, target_height)
+            else:
+                matrix = pad_matrix(source_width, source_height, target_width, target_height)
+            self._fit_matrices[key] = matrix
+        return self._fit_matrices[key]
+
+    def _apply_geometry(self):
+        name = "media.shift_and_zoom" if self.ken_burns else "media.fit"
+        transform = tracing.frame_timer(name, self._transform_frame)
+        self.clip = self.clip.fl(lambda gf, t: transform(gf(t), t))
+
+    def _build_still_clip(self):
+        height, width = self.image.shape[:2]
+        self.base_frame = warp_frame(self.image, self._fit_matrix(width, height), self.final_clip_frame_size)
+        # Only the fitted frame is needed from now on
+        self.image = None
+        duration = self.get_duration()
+        if self.ken_burns:
+            self.clip = VideoClip(tracing.frame_timer("media.shift_and_zoom", self._still_frame), duration=duration)
         else:
-            # Clip is too tall, match the width first
-            new_width = target_width
-            new_height = int(target_width / clip_aspect_ratio)
-
-        # Resize the clip
-        self.clip = self.clip.resize(height=new_height, width=new_width)
-
-        # Calculate cropping boundaries
-        left_crop = (new_width - target_width) // 2
-        top_crop = (new_height - target_height) // 2
+            # Without shift and zoom every frame is the same buffer, there is no per-frame work
+            self.clip = ImageClip(self.base_frame, duration=duration)
+        self.clip = self.clip.set_fps(self.fps)
 
-        # Crop the clip
-        self.clip = self.clip.crop(
-            x1=left_crop,
-            y1=top_crop,
-            x2=left_crop + target_width,
-            y2=top_crop + target_height
-        )
+    def _still_frame(self, t):
+        target_width, target_height = self.final_clip_frame_size
+        matrix = ken_burns_matrix(target_width, target_height, t,
+                                  max_shift_factor=self.max_shift_factor,
+                                  max_zoom_factor=self.max_zoom_factor,
+                                  duration=self.get_duration() * 1.2)
+        self._frame_buffer = warp_frame(self.base_frame, matrix, self.final_clip_frame_size, self._frame_buffer)
+        return self._frame_buffer
+
+    def _transform_frame(self, frame, t):
+        height, width = frame.shape[:2]
+        matrix = self._fit_matrix(width, height)
+        if self.ken_burns:
+            target_width, target_height = self.final_clip_frame_size
+            matrix = ken_burns_matrix(target_width, target_height, t,
+                                      max_shift_factor=self.max_shift_factor,
+                                      max_zoom_factor=self.max_zoom_factor,
+                                      duration=self.get_duration() * 1.2) @ matrix
+        self._frame_buffer = warp_frame(frame, matrix, self.final_clip_frame_size, self._frame_buffer)
+        return self._frame_buffer
 
     def trim(self, time):
         self.clip = self.clip.subclip(time)
@@ -141,23 +186,106 @@ class Media:
         return self.clip.duration
 
 
-def shift_and_zoom(get_frame, t, max_shift_factor=0.18, max_zoom_factor=5, duration=10.0):
+def load_image(path):
     """
-    Shifts the center of the frame towards the top and zoom into it,
+    Decode an image file to an RGB array.
+
+    :param path: Path to the image
+    :return: uint8 array of shape (height, width, 3)
+    """
+    # imdecode instead of imread so that non-ascii paths also work on Windows
+    image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read image {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def warp_frame(frame, matrix, frame_size, out=None):
+    """
+    Apply an affine transform to a frame with a single resampling.
+
+    :param frame: The source frame
+    :param matrix: 3x3 affine matrix mapping source coordinates to output coordinates (pixel edges at 0)
+    :param frame_size: The (width, height) of the output frame
+    :param out: Optional uint8 buffer of the output size, reused when given
+    :return: The transformed frame
+    """
+    if frame.ndim == 3 and frame.shape[2] == 4:
+        frame = frame[:, :, :3]
+    width, height = frame_size
+    if out is None or out.shape[:2] != (height, width):
+        out = np.zeros((height, width, 3), dtype=np.uint8)
+    # OpenCV samples at pixel centers while the matrices are built with pixel edges at 0
+    centered = matrix[:2].copy()
+    centered[:, 2] += centered[:, :2].sum(axis=1) * 0.5 - 0.5
+    cv2.warpAffine(frame, centered, (width, height), dst=out, flags=cv2.INTER_LINEAR,
+                   borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+    return out
+
+
+def affine(scale_x, scale_y, translate_x=0.0, translate_y=0.0):
+    return np.array([[scale_x, 0, translate_x],
+                     [0, scale_y, translate_y],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def pad_matrix(source_width, source_height, width, height):
+    """
+    Matrix fitting a frame inside (width, height) with black padding, the padding on top being larger than at
+    the bottom. Same geometry as resizing, adding margins and resizing again, but as a single transform.
+    """
+    target_aspect_ratio = width / height
+    current_aspect_ratio = source_width / source_height
+
+    if current_aspect_ratio > target_aspect_ratio:
+        # The video is too wide, need to add padding at the top and bottom
+        resized_height = int(source_height * width / source_width)
+        padding = (int(width / target_aspect_ratio) - resized_height) // 2
+        top, bottom = int(padding * 1.3), int(padding * 0.7)
+        factor = height / (resized_height + top + bottom)
+        return affine(width / source_width, resized_height * factor / source_height, 0, top * factor)
+    # The video is too tall, need to add padding on the sides
+    resized_width = int(source_width * height / source_height)
+    padding = (int(height * target_aspect_ratio) - resized_width) // 2
+    factor = width / (resized_width + 2 * padding)
+    return affine(resized_width * factor / source_width, height / source_height, padding * factor, 0)
+
+
+def crop_matrix(source_width, source_height, width, height):
+    """
+    Matrix resizing a frame to cover (width, height) and cropping it equally from the center.
+    """
+    target_aspect_ratio = width / height
+    clip_aspect_ratio = source_width / source_height
+
+    # Decide which dimension to match first (width or height) based on aspect ratio
+    if clip_aspect_ratio > target_aspect_ratio:
+        # Clip is too wide, match the height first
+        new_height = height
+        new_width = int(height * clip_aspect_ratio)
+    else:
+        # Clip is too tall, match the width first
+        new_width = width
+        new_height = int(width / clip_aspect_ratio)
+
+    left_crop = (new_width - width) // 2
+    top_crop = (new_height - height) // 2
+    return affine(new_width / source_width, new_height / source_height, -left_crop, -top_crop)
+
+
+def ken_burns_matrix(width, height, t, max_shift_factor=0.18, max_zoom_factor=5, duration=10.0):
+    """
+    Matrix shifting the center of a (width, height) frame towards the top and zooming into it,
     based on the time t in the video.
 
-    :param get_frame: Function to get the current frame at time t
+    :param width: Width of the frame
+    :param height: Height of the frame
     :param t: Current time in the video
     :param max_shift_factor: Maximum factor by which to shift the center towards the top
     :param max_zoom_factor: Maximum factor by which to zoom the frame
     :param duration: Duration of the video clip
-    :return: Shifted and zoomed frame
+    :return: 3x3 affine matrix
     """
-
-    frame = get_frame(t)
-
-    height, width, _ = frame.shape
-
     # Calculate shift and zoom factors based on time
     shift_factor = max_shift_factor * (t / duration)
     zoom_factor = 1 + ((max_zoom_factor - 1) * (t / duration))
@@ -165,26 +293,38 @@ def shift_and_zoom(get_frame, t, max_shift_factor=0.18, max_zoom_factor=5, durat
     # Calculate the amount to shift
     shift_amount = int(height * shift_factor)
 
-    # Perform the shift using UMat
-    shifted_frame_umat = cv2.UMat(frame[shift_amount:, :, :])
-    shifted_frame_umat = cv2.copyMakeBorder(shifted_frame_umat, 0, shift_amount, 0, 0, cv2.BORDER_CONSTANT,
-                                            value=[0, 0, 0])
-
     # Calculate new size for zoom
     new_width = width * zoom_factor
     new_height = height * zoom_factor
-
-    # Perform zoom
-    zoomed_frame_umat = cv2.resize(shifted_frame_umat, (round(new_width), round(new_height)))
+    scale_x = round(new_width) / width
+    scale_y = round(new_height) / height
 
     # Calculate top and left positions for cropping
     top = int((new_height - height) / 2)
     left = int((new_width - width) / 2)
 
-    # Crop to original frame size
-    zoomed_frame = zoomed_frame_umat.get()[top:top + height, left:left + width]
+    return affine(scale_x, scale_y, -left, -shift_amount * scale_y - top)
 
-    return zoomed_frame
+
+def shift_and_zoom(get_frame, t, max_shift_factor=0.18, max_zoom_factor=5, duration=10.0):
+    """
+    Shifts the center of the frame towards the top and zoom into it,
+    based on the time t in the video.
+
+    :param get_frame: Function to get the current frame at time t
+    :param t: Current time in the video
+    :param max_shift_factor: Maximum factor by which to shift the center towards the top
+    :param max_zoom_factor: Maximum factor by which to zoom the frame
+    :param duration: Duration of the video clip
+    :return: Shifted and zoomed frame
+    """
+
+    frame = get_frame(t)
+
+    height, width = frame.shape[:2]
+    matrix = ken_burns_matrix(width, height, t, max_shift_factor=max_shift_factor,
+                              max_zoom_factor=max_zoom_factor, duration=duration)
+    return warp_frame(frame, matrix, (width, height))
 
 
 def pad_video_to_aspect_ratio(video_clip, width, height):
@@ -192,26 +332,12 @@ def pad_video_to_aspect_ratio(video_clip, width, height):
     Pad the video to a specific aspect ratio.
 
     :param video_clip: The original video clip
-    :param target_aspect_ratio: The target aspect ratio (width / height)
+    :param width: The target width
+    :param height: The target height
     :return: A new video clip with padding
     """
-    target_aspect_ratio = width / height
-    current_aspect_ratio = video_clip.size[0] / video_clip.size[1]
-
-    if current_aspect_ratio > target_aspect_ratio:
-        video_clip = video_clip.resize(width=width)
-        # The video is too wide, need to add padding at the top and bottom
-        new_height = int(video_clip.size[0] / target_aspect_ratio)
-        padding = (new_height - video_clip.size[1]) // 2
-        padded_clip = video_clip.margin(top=int(padding * 1.3), bottom=int(padding * 0.7), color=(0, 0, 0))
-    else:
-        video_clip = video_clip.resize(height=height)
-        # The video is too tall, need to add padding on the sides
-        new_width = int(video_clip.size[1] * target_aspect_ratio)
-        padding = (new_width - video_clip.size[0]) // 2
-        padded_clip = video_clip.margin(left=padding, right=padding, color=(0, 0, 0))
-
-    return padded_clip.resize(newsize=(width, height))
+    return video_clip.fl_image(
+        lambda frame: warp_frame(frame, pad_matrix(frame.shape[1], frame.shape[0], width, height), (width, height)))
 
 
 def parse_filename(filename):
@@ -0,0 +1,88 @@
+import json
+import os
+
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from PIL import Image
+
+from src.media import parse_filename
+from src.utils import atomic_write_json
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def probe_video(path):
+    """
+    Read the metadata of a video from its header, without keeping a reader open on the file.
+    """
+    infos = ffmpeg_parse_infos(path)
+    width, height = infos.get("video_size") or (0, 0)
+    rotation = infos.get("video_rotation", 0) or 0
+    if rotation in (90, 270):
+        # The frames are rotated when read, like VideoFileClip does
+        width, height = height, width
+    return {"type": "video", "width": width, "height": height, "duration": infos["duration"],
+            "fps": infos.get("video_fps"), "rotation": rotation}
+
+
+def probe_image(path):
+    # Only the header is read, the pixels are decoded when the image is rendered
+    with Image.open(path) as image:
+        width, height = image.size
+    return {"type": "image", "width": width, "height": height, "duration": None, "fps": None, "rotation": 0}
+
+
+class MediaIndex:
+    """
+    Metadata of every media of a folder, stored in a .media_index.json file inside it: type, dimensions, duration,
+    fps, rotation and the options parsed from the file name. Files whose mtime and size did not change are not probed
+    again, so planning a video from a folder of reused assets does not touch the media bytes.
+    """
+    FILE_NAME = ".media_index.json"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = self._read()
+
+    def _path(self):
+        return os.path.join(self.folder, self.FILE_NAME)
+
+    def _read(self):
+        try:
+            with open(self._path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def refresh(self):
+        """
+        Probe the new and modified media of the folder and forget the removed ones.
+
+        :return: The entries, a dict mapping each media file name to its metadata, sorted by file name
+        """
+        entries = {}
+        changed = False
+        for file_name in sorted(os.listdir(self.folder)):
+            if not file_name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                continue
+            path = os.path.join(self.folder, file_name)
+            stat = os.stat(path)
+            entry = self.entries.get(file_name)
+            if entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                try:
+                    entry = probe_video(path) if file_name.lower().endswith(VIDEO_EXTENSIONS) else probe_image(path)
+                except Exception as e:
+                    print(f"Could not read {path}: {e}")
+                    continue
+                entry.update(mtime=stat.st_mtime_ns, size=stat.st_size, options=parse_filename(file_name))
+                changed = True
+            entries[file_name] = entry
+        changed = changed or entries.keys() != self.entries.keys()
+        self.entries = entries
+        if changed:
+            try:
+                atomic_write_json(self._path(), self.entries)
+            except OSError as e:
+                # A read-only media folder is still usable, it is probed again next time
+                print(f"Could not write the media index of {self.folder}: {e}")
+        return self.entries
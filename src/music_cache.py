@@ -0,0 +1,76 @@
+import glob
+import os
+import tempfile
+from hashlib import sha256
+
+import numpy as np
+
+from src.audio_mixer import resample, to_float, to_int16
+from src.utils import get_config, Audio
+
+
+class MusicCache:
+    """
+    Decoded music beds stored as .npy files in cache_dir/music, keyed by the path and modification time of the music
+    file and the sample rate they were resampled to. Jobs and worker processes map the same file read-only instead of
+    decoding the mp3 again for every video.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(get_config().cache_dir, "music")
+
+    @staticmethod
+    def _prefix(music_path):
+        return sha256(os.path.abspath(music_path).encode("utf-8")).hexdigest()[:16]
+
+    def path(self, music_path, sample_rate):
+        stat = os.stat(music_path)
+        return os.path.join(self.cache_dir,
+                            f"{self._prefix(music_path)}_{stat.st_mtime_ns}_{stat.st_size}_{sample_rate}.npy")
+
+    def get_samples(self, music_path, sample_rate):
+        """
+        :param music_path: Path of the music file
+        :param sample_rate: Sample rate the music is needed at, usually the one of the voice
+        :return: A read-only memory map of the int16 samples, of shape (n_samples, n_channels)
+        """
+        cache_path = self.path(music_path, sample_rate)
+        try:
+            return np.load(cache_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError, EOFError):
+            pass
+
+        music = Audio(music_path)
+        samples = music.get_samples()
+        if music.get_sample_rate() != sample_rate or samples.dtype != np.int16:
+            samples = to_int16(resample(to_float(samples), music.get_sample_rate(), sample_rate))
+        self._store(cache_path, samples)
+        self._remove_stale(music_path, cache_path)
+        return np.load(cache_path, mmap_mode="r")
+
+    def get_audio(self, music_path, sample_rate, scratch_dir=None):
+        return Audio.from_samples(self.get_samples(music_path, sample_rate), sample_rate, scratch_dir=scratch_dir)
+
+    def _store(self, cache_path, samples):
+        # Written to a temporary file then renamed, a worker never maps a file another one is still writing
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp_", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(samples))
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _remove_stale(self, music_path, cache_path):
+        # Entries of an older version of the same music file are never used again
+        stat = os.stat(music_path)
+        current = f"{self._prefix(music_path)}_{stat.st_mtime_ns}_{stat.st_size}_"
+        for path in glob.glob(os.path.join(self.cache_dir, f"{self._prefix(music_path)}_*.npy")):
+            if not os.path.basename(path).startswith(current) and path != cache_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,192 @@
+"""
+A staged pipeline: every stage has its own pool of worker threads and a bounded input queue. A stage whose next queue
+is full blocks, so a fast stage never runs more than queue_size items ahead of a slow one and the memory held by the
+items in flight stays bounded. Stages doing CPU work in Python submit it to a process pool from their threads.
+"""
+import queue
+import threading
+import time
+import traceback
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, function, workers=1, queue_size=2):
+        """
+        :param function: Called with an item, returns the item given to the next stage
+        :param workers: Number of threads running the stage
+        :param queue_size: Number of items waiting for the stage at most
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.lock = threading.Lock()
+        self.running = 0  # Worker threads not stopped yet
+        self.busy = 0  # Worker threads running the function
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        # Queue occupancy sampled during the run
+        self.samples = 0
+        self.queued_sum = 0
+        self.queued_max = 0
+        self.full_samples = 0
+
+    def sample(self):
+        queued = self.queue.qsize()
+        self.samples += 1
+        self.queued_sum += queued
+        self.queued_max = max(self.queued_max, queued)
+        self.full_samples += queued >= self.queue_size
+
+    def stats(self, elapsed):
+        """
+        :param elapsed: Duration of the run in seconds
+        :return: The items processed by the stage, the time spent per item, the fraction of the time its workers were
+            busy, and the mean and max number of items waiting in its queue and the fraction of the time it was full
+        """
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "mean_time": self.busy_time / self.processed if self.processed else 0.0,
+            "utilization": self.busy_time / (self.workers * elapsed) if elapsed > 0 else 0.0,
+            "queue_size": self.queue_size,
+            "mean_queued": self.queued_sum / self.samples if self.samples else 0.0,
+            "max_queued": self.queued_max,
+            "full": self.full_samples / self.samples if self.samples else 0.0,
+        }
+
+
+class PipelineResult:
+    def __init__(self, item, error=None, traceback_text=None, stage=None):
+        self.item = item
+        self.error = error
+        self.traceback_text = traceback_text
+        self.stage = stage  # Name of the stage that failed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Pipeline:
+    """
+    Runs items through stages in order. An item whose stage raises skips the next stages and is returned with the
+    error. Results are returned as the items leave the last stage, not in the order of the input.
+    """
+
+    def __init__(self, stages, sample_interval=0.5):
+        self.stages = stages
+        self.sample_interval = sample_interval
+        self.output = queue.Queue()
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._feed_error = None
+
+    def run(self, items):
+        """
+        :param items: Iterable of items, consumed as the first stage has room, so it can be a generator of any length
+        :return: A generator of PipelineResult
+        """
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True),
+                   threading.Thread(target=self._sample, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            stage.running = stage.workers
+            threads += [threading.Thread(target=self._work, args=(index,), daemon=True) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while (result := self.output.get()) is not _DONE:
+                yield result
+            if self._feed_error is not None:
+                raise self._feed_error
+        finally:
+            # Also when the caller stops early: the threads stop at their next item
+            self._stop.set()
+            self.elapsed = time.perf_counter() - start
+
+    def _put(self, target, item):
+        # Blocks while the queue is full, which is the backpressure on the previous stages
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    return
+                self._put(self.stages[0].queue, item)
+        except Exception as e:
+            self._feed_error = e
+        for _ in range(self.stages[0].workers):
+            self._put(self.stages[0].queue, _DONE)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        last_stage = index == len(self.stages) - 1
+        next_queue = self.output if last_stage else self.stages[index + 1].queue
+        while (item := self._get(stage.queue)) is not _DONE:
+            with stage.lock:
+                stage.busy += 1
+            start = time.perf_counter()
+            try:
+                item = stage.function(item)
+                error = None
+            except Exception as e:
+                error = PipelineResult(item, f"{type(e).__name__}: {e}", traceback.format_exc(), stage.name)
+            with stage.lock:
+                stage.busy -= 1
+                stage.processed += 1
+                stage.failed += error is not None
+                stage.busy_time += time.perf_counter() - start
+            if error is not None:
+                self.output.put(error)
+            else:
+                self._put(next_queue, PipelineResult(item) if last_stage else item)
+        with stage.lock:
+            stage.running -= 1
+            stopped = stage.running == 0
+        # The last thread of a stage to stop stops the next stage, once all the items it produced are queued
+        if stopped:
+            if last_stage:
+                self.output.put(_DONE)
+            else:
+                for _ in range(self.stages[index + 1].workers):
+                    self._put(next_queue, _DONE)
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            for stage in self.stages:
+                stage.sample()
+
+    def stats(self):
+        return {stage.name: stage.stats(self.elapsed) for stage in self.stages}
+
+    def print_report(self):
+        """
+        Print the occupancy of every stage. A stage whose workers are always busy while the queue in front of it is
+        often full is the bottleneck and needs more workers, a stage whose workers are mostly idle has too many.
+        """
+        print(f"Pipeline ran for {self.elapsed:.1f}s")
+        print(f"{'stage':<10}{'workers':>8}{'items':>7}{'failed':>7}{'s/item':>8}{'busy':>7}{'queued':>14}{'full':>7}")
+        for name, stats in self.stats().items():
+            queued = f"{stats['mean_queued']:.1f}/{stats['max_queued']} of {stats['queue_size']}"
+            print(f"{name:<10}{stats['workers']:>8}{stats['processed']:>7}{stats['failed']:>7}"
+                  f"{stats['mean_time']:>8.2f}{stats['utilization']:>7.0%}{queued:>14}{stats['full']:>7.0%}")
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import tempfile
+from hashlib import sha256
+
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from src.utils import get_config
+
+# Bytes read at the start and at the end of a video to address its proxy
+SAMPLE_BYTES = 1024 * 1024
+
+
+def content_key(path):
+    """
+    Hash of the size and of the first and last MB of a file: stock clips are large, reading them entirely on every
+    render would cost more than the decode the proxy saves.
+    """
+    size = os.path.getsize(path)
+    digest = sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if size > 2 * SAMPLE_BYTES:
+            f.seek(-SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+class ProxyCache:
+    """
+    Videos transcoded once to about the output frame size and fps, stored in cache_dir/proxies and addressed by their
+    content and the output settings. The proxy is downscaled to cover the frame (cropping and padding both still have
+    every output pixel) and has a keyframe every second so trimming seeks quickly. Decoding then costs about the same
+    whatever the resolution of the source.
+    """
+
+    def __init__(self, cache_dir=None, enabled=None, crf=None, preset=None, config=None):
+        config = config if config is not None else get_config()
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(config.cache_dir, "proxies")
+        self.enabled = enabled if enabled is not None else config.proxy_enabled
+        self.crf = crf if crf is not None else config.proxy_crf
+        self.preset = preset if preset is not None else config.proxy_preset
+
+    def path(self, source_path, frame_size, fps):
+        width, height = frame_size
+        settings = f"{width}x{height}_{fps}_{self.crf}"
+        return os.path.join(self.cache_dir, f"{content_key(source_path)}_{settings}.mp4")
+
+    @staticmethod
+    def proxy_size(source_path, frame_size):
+        """
+        :return: The size of the source once scaled to cover the frame without upscaling it, the scale factor and the
+            fps of the source
+        """
+        infos = ffmpeg_parse_infos(source_path)
+        width, height = infos["video_size"]
+        if infos.get("video_rotation", 0) in (90, 270):
+            width, height = height, width
+        scale = min(1.0, max(frame_size[0] / width, frame_size[1] / height))
+        # Even dimensions for yuv420p
+        size = (max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2))
+        return size, scale, infos.get("video_fps")
+
+    def get(self, source_path, frame_size, fps):
+        """
+        :return: The path of the proxy of the video, created if needed, or the source path if proxies are disabled,
+            not useful for this source, or if the transcode failed
+        """
+        if not self.enabled:
+            return source_path
+        try:
+            proxy_path = self.path(source_path, frame_size, fps)
+            if os.path.isfile(proxy_path):
+                return proxy_path
+            size, scale, source_fps = self.proxy_size(source_path, frame_size)
+            # Sources that are not much larger than the frame nor faster than the output are decoded as they are
+            if scale > 0.9 and (source_fps or 0) <= fps * 1.1:
+                return source_path
+            self._transcode(source_path, proxy_path, size, fps)
+            return proxy_path
+        except Exception as e:
+            print(f"Could not create the proxy of {source_path}, using the source: {e}")
+            return source_path
+
+    def ffmpeg_command(self, source_path, output_path, size, fps):
+        width, height = size
+        keyframe_interval = str(max(1, int(round(fps))))
+        return [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error", "-i", source_path, "-an",
+                "-vf", f"scale={width}:{height},fps={fps}", "-c:v", "libx264", "-preset", self.preset,
+                "-crf", str(self.crf), "-g", keyframe_interval, "-keyint_min", keyframe_interval,
+                "-sc_threshold", "0", "-pix_fmt", "yuv420p", "-movflags", "+faststart", "-f", "mp4", output_path]
+
+    def _transcode(self, source_path, proxy_path, size, fps):
+        # Written to a temporary file then renamed, parallel jobs never read a proxy that is still being written
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp_", suffix=".mp4")
+        os.close(fd)
+        try:
+            process = subprocess.run(self.ffmpeg_command(source_path, tmp_path, size, fps),
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}: "
+                                   f"{process.stderr.decode(errors='replace').strip()}")
+            os.replace(tmp_path, proxy_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
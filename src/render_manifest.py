@@ -0,0 +1,86 @@
+import json
+import os
+import time
+from hashlib import sha256
+
+from src.utils import get_config, atomic_write_json
+
+# Settings a video depends on, an output rendered with other values is rendered again
+CONFIG_FIELDS = (
+    "frame_size", "fps", "music_proportion", "music_fade_in", "music_fade_out", "duck_db", "duck_threshold_db",
+    "subtitle_pos", "subtitle_nb_word", "subtitle_nb_word_per_line", "subtitle_font", "subtitle_font_size",
+    "fade_duration", "show_title", "time_title", "title_font_size", "background_title", "background_title_opacity",
+    "color_title", "title_nb_word_per_line", "encoding_profile", "encoding_profiles", "draft_scale", "draft_fps",
+    "draft_profile", "proxy_enabled", "proxy_crf",
+)
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def folder_signature(folder):
+    # Names, modification times and sizes are enough to notice an added, removed or replaced media
+    signature = []
+    for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            signature.append([entry.name, stat.st_mtime_ns, stat.st_size])
+    return signature
+
+
+class RenderManifest:
+    """
+    A <video>.manifest.json file next to each rendered video, recording the hash of everything the video was rendered
+    from: script, title, voice, music, media folder content and the settings of CONFIG_FIELDS. A video whose
+    manifest matches the current inputs is up to date and does not need to be rendered again.
+
+    The manifest of a video is removed before the video is rendered again and written once the render succeeded, so
+    a render that fails or is interrupted never leaves a manifest describing what is at the video path.
+    """
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else get_config()
+
+    @staticmethod
+    def path(video_path):
+        return os.path.splitext(video_path)[0] + ".manifest.json"
+
+    def inputs(self, script, title, voice_key, music_path, media_folder, draft=False):
+        """
+        :param voice_key: Identifier of the voice audio, the key of the voice in the TTS cache
+        :return: The inputs of the video as a JSON-serializable dict
+        """
+        settings = self.config.fields()
+        return {
+            "script": script,
+            "title": title,
+            "voice": voice_key,
+            "music": file_signature(music_path) if music_path is not None and os.path.isfile(music_path) else None,
+            "media": folder_signature(media_folder) if os.path.isdir(media_folder) else None,
+            "config": {field: settings.get(field) for field in CONFIG_FIELDS},
+            "draft": draft,
+        }
+
+    @staticmethod
+    def digest(inputs):
+        return sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def is_up_to_date(self, video_path, digest):
+        if not os.path.isfile(video_path):
+            return False
+        try:
+            with open(self.path(video_path), "r", encoding="utf-8") as f:
+                return json.load(f).get("digest") == digest
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def remove(self, video_path):
+        try:
+            os.remove(self.path(video_path))
+        except FileNotFoundError:
+            pass
+
+    def write(self, video_path, digest, inputs=None):
+        atomic_write_json(self.path(video_path), {"digest": digest, "rendered_at": time.time(), "inputs": inputs})
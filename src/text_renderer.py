@@ -0,0 +1,190 @@
+import os
+import shutil
+import subprocess
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+FONT_DIRS = ["resources/fonts/", "resources/"]
+FONT_EXTENSIONS = ("", ".ttf", ".otf", ".ttc")
+EMOJI_FONT_PATH = "resources/seguiemj.ttf"
+# Used in this order when a font cannot be found, the last one is shipped with most Linux distributions
+FALLBACK_FONTS = ("arial.ttf", "DejaVuSans.ttf")
+
+_missing_fonts = set()  # Fonts already reported as not found, so the warning is printed once per process
+
+
+class RenderedText:
+    def __init__(self, rgb, alpha):
+        self.rgb = rgb  # uint8 array (height, width, 3)
+        self.alpha = alpha  # uint8 array (height, width)
+
+    @property
+    def w(self):
+        return self.rgb.shape[1]
+
+    @property
+    def h(self):
+        return self.rgb.shape[0]
+
+
+def _normalize_font_name(name):
+    return "".join(c for c in name.lower() if c.isalnum())
+
+
+@lru_cache(maxsize=None)
+def system_font_path(font):
+    """
+    Find the file of a font installed on the system from its name, as given to ImageMagick, e.g. Lucida-Bright-Demibold
+    is LBRITED.TTF on Windows. The Windows font registry is searched on Windows, fontconfig (fc-match) elsewhere.
+
+    :return: The path of the font file, or None if no installed font has this name
+    """
+    wanted = _normalize_font_name(font)
+    if sys.platform == "win32":
+        import winreg
+        key_path = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Fonts"
+        for root in (winreg.HKEY_LOCAL_MACHINE, winreg.HKEY_CURRENT_USER):
+            try:
+                with winreg.OpenKey(root, key_path) as key:
+                    for i in range(winreg.QueryInfoKey(key)[1]):
+                        name, file_name, _ = winreg.EnumValue(key, i)
+                        # Values are named like "Lucida Bright Demibold (TrueType)"
+                        if _normalize_font_name(name.split(" (")[0]) == wanted:
+                            return os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", file_name)
+            except OSError:
+                continue
+        return None
+    if shutil.which("fc-match") is None:
+        return None
+    try:
+        output = subprocess.run(["fc-match", "-f", "%{file}\n%{fullname}\n%{family}", font.replace("-", " ")],
+                                capture_output=True, text=True, timeout=10).stdout.split("\n")
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if len(output) < 3:
+        return None
+    path, full_names, families = output[:3]
+    # fc-match always returns a font, the closest one: it is only used if its name is the one asked for
+    names = full_names.split(",") + families.split(",")
+    return path if any(_normalize_font_name(name) == wanted for name in names) else None
+
+
+def load_font(font, font_size):
+    """
+    Load a font for Pillow. `font` can be a path to a font file, the name of a file in one of FONT_DIRS or a font
+    installed on the system, with or without its extension, or the name of an installed font (see system_font_path).
+
+    :param font: The font name or path
+    :param font_size: The font size in pixels
+    :return: A FreeType font
+    """
+    candidates = [font + extension for extension in FONT_EXTENSIONS]
+    for font_dir in FONT_DIRS:
+        candidates += [os.path.join(font_dir, font + extension) for extension in FONT_EXTENSIONS]
+    for candidate in candidates:
+        try:
+            # Pillow also looks for non-existing paths in the system font folders
+            return ImageFont.truetype(candidate, font_size)
+        except (IOError, ValueError):
+            continue
+    path = system_font_path(font)
+    if path is not None:
+        try:
+            return ImageFont.truetype(path, font_size)
+        except (IOError, ValueError):
+            pass
+    if font not in _missing_fonts:
+        _missing_fonts.add(font)
+        print(f"Font {font} not found, using {' or '.join(FALLBACK_FONTS)} instead")
+    for fallback in FALLBACK_FONTS:
+        try:
+            return ImageFont.truetype(fallback, font_size)
+        except IOError:
+            continue
+    try:
+        # Pillow 10.1 and later, a scalable font of the given size
+        return ImageFont.load_default(size=font_size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+class TextRenderer:
+    """
+    Rasterize subtitle words in-process with Pillow/FreeType. Rendered words are kept in a bounded LRU cache keyed
+    by (text, font, size, color, shadow), shadows are built from the alpha mask of the cached word.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._fonts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, font, font_size):
+        key = (font, font_size)
+        if key not in self._fonts:
+            self._fonts[key] = load_font(font, font_size)
+        return self._fonts[key]
+
+    def _get_cached(self, key):
+        rendered = self._cache.get(key)
+        if rendered is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return rendered
+
+    def _put(self, key, rendered):
+        self._cache[key] = rendered
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return rendered
+
+    def render_word(self, text, font, font_size, color="white", shadow=False):
+        """
+        Render a word, or its shadow (black, with the same alpha mask) when `shadow` is True.
+
+        :return: A RenderedText
+        """
+        key = (text, font, font_size, color, shadow)
+        rendered = self._get_cached(key)
+        if rendered is not None:
+            return rendered
+
+        if shadow:
+            word = self.render_word(text, font, font_size, color)
+            return self._put(key, RenderedText(np.zeros_like(word.rgb), word.alpha))
+
+        pil_font = self.get_font(font, font_size)
+        ascent, descent = pil_font.getmetrics()
+        right = pil_font.getbbox(text)[2]
+        width = max(1, int(np.ceil(max(pil_font.getlength(text), right))))
+        mask = Image.new("L", (width, ascent + descent), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, font=pil_font, fill=255)
+        rgb = np.empty((mask.height, mask.width, 3), dtype=np.uint8)
+        rgb[:] = ImageColor.getrgb(color)[:3]
+        return self._put(key, RenderedText(rgb, np.array(mask)))
+
+    def space_width(self, font, font_size):
+        return int(round(self.get_font(font, font_size).getlength(" ")))
+
+    def render_emoji(self, emoji, font_size):
+        key = (emoji, EMOJI_FONT_PATH, font_size, None, False)
+        rendered = self._get_cached(key)
+        if rendered is not None:
+            return rendered
+
+        # Create an image with transparent background
+        image = Image.new("RGBA", (font_size, font_size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        font = self.get_font(os.path.abspath(EMOJI_FONT_PATH), font_size)
+        draw.text((0, 0), emoji, font=font, fill=(255, 255, 255, 255), embedded_color=True)
+        pixels = np.array(image)
+        return self._put(key, RenderedText(np.ascontiguousarray(pixels[:, :, :3]),
+                                           np.ascontiguousarray(pixels[:, :, 3])))
@@ -1,52 +1,200 @@
-import os
-from hashlib import md5
-from src.utils import Config, Audio  # Import the Config class from utils module
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.tts_cache import TTSCache
+from src.utils import get_config, Audio  # The settings, loaded once per process
 from elevenlabs import set_api_key, generate
 
 
 class ElevenLabsAPI:
     def __init__(self):
-        self.config = Config()
+        self.config = get_config()
         self.api_key = self.config.elevenlabs_api_key
         set_api_key(self.api_key)
 
     def text_to_speech(self, script):
-        try:
-            audio = generate(
-                text=script,
-                voice=self.config.elevenlabs_voice,
-                model=self.config.elevenlabs_model
-            )
-            return audio
-        except Exception as e:
-            print(f"An error occurred while calling the ElevenLabs API: {e}")
-            return None
+        # Errors are raised, the caller decides whether they are worth a retry (see is_retryable)
+        return generate(
+            text=script,
+            voice=self.config.elevenlabs_voice,
+            model=self.config.elevenlabs_model
+        )
+
+
+# HTTP statuses worth a retry besides the server errors: timeouts and rate limits. The other client errors (invalid
+# key, quota exceeded, unknown voice) fail the same way every time
+RETRYABLE_STATUSES = {408, 409, 425, 429}
+
+
+def _status_code(error):
+    # The HTTP status of the error or of the error it was raised from, or of their response
+    for exception in (error, error.__cause__):
+        for source in (exception, getattr(exception, "response", None)):
+            for name in ("status_code", "status"):
+                status = getattr(source, name, None)
+                if isinstance(status, int):
+                    return status
+    return None
+
+
+def is_retryable(error):
+    """
+    :return: False if the error is an HTTP client error that will be returned again, True otherwise
+    """
+    status = _status_code(error)
+    return status is None or status >= 500 or status in RETRYABLE_STATUSES
 
 
 class TextToSpeech:
-    def __init__(self):
-        self.api = ElevenLabsAPI()  # Instantiate the API class
-        config = Config()
-        self.audio_dir = config.audio_dir
+    def __init__(self, api=None, cache=None):
+        # Any object with a text_to_speech(script) method returning the mp3 bytes can be given as api
+        self.api = api if api is not None else ElevenLabsAPI()  # Instantiate the API class
+        self.config = get_config()
+        self.cache = cache if cache is not None else TTSCache()
 
-    def get_audio(self, script):
-        # Generate a hash of the script to use for the file name
-        script_hash = md5(script.encode()).hexdigest()
-        audio_file_path = os.path.join(self.audio_dir, f"{script_hash}.mp3")
-        if os.path.isfile(audio_file_path):
-            return Audio(audio_file_path)
+    def cache_key(self, script):
+        # The voice and the model are part of the key, changing them must not return the audio of the old voice
+        return TTSCache.key(script, self.config.elevenlabs_voice, self.config.elevenlabs_model, "mp3")
+
+    def is_cached(self, script):
+        return self.cache.contains(self.cache_key(script))
+
+    def synthesize(self, script):
+        """
+        Call the API for the script and save the audio, raise a RuntimeError if the API did not return any audio.
 
+        :return: The path of the saved audio and its data
+        """
         # Make an API call to get the audio data
         audio_data = self.api.text_to_speech(script)  # Using ElevenLabsAPI class
+        if not audio_data:
+            raise RuntimeError("The text to speech API did not return any audio")
+
+        # Save the audio data to the cache
+        audio_file_path = self.cache.put(self.cache_key(script), audio_data, "mp3")
+        return audio_file_path, audio_data
+
+    def get_audio(self, script):
+        audio_file_path = self.cache.get(self.cache_key(script))
+        if audio_file_path is not None:
+            return Audio(audio_file_path)
 
-        # Save the audio data to a file
-        with open(audio_file_path, 'wb') as f:
-            f.write(audio_data)
+        audio_file_path, audio_data = self.synthesize(script)
 
         # Create and return an Audio object
         return Audio(audio_file_path, audio_data)
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens are added per second, up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"Invalid rate limit of {rate} requests per second with a burst of {capacity}, the rate "
+                             f"must be positive and the burst at least 1")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TTSPrefetcher:
+    """
+    Synthesize the voice of many scripts before rendering. Scripts are deduplicated, the ones already on disk are
+    skipped and the others are requested concurrently, with a cap on the number of requests in flight, a token bucket
+    rate limit and retries with exponential backoff. HTTP client errors other than timeouts and rate limits are not
+    retried.
+    """
+
+    def __init__(self, tts=None, max_concurrency=None, requests_per_second=None, burst=None, max_retries=None,
+                 backoff_base=None, backoff_max=None):
+        config = get_config()
+        self.tts = tts if tts is not None else TextToSpeech()
+        self.max_concurrency = max_concurrency if max_concurrency is not None else config.tts_max_concurrency
+        self.max_retries = max_retries if max_retries is not None else config.tts_max_retries
+        self.backoff_base = backoff_base if backoff_base is not None else config.tts_backoff_base
+        self.backoff_max = backoff_max if backoff_max is not None else config.tts_backoff_max
+        self.rate_limiter = TokenBucket(
+            requests_per_second if requests_per_second is not None else config.tts_requests_per_second,
+            burst if burst is not None else config.tts_burst)
+
+    def prefetch(self, scripts):
+        """
+        Make sure the voice of every script is on disk.
+
+        :param scripts: Iterable of scripts, duplicates and blank scripts are ignored
+        :return: A dict mapping each script whose synthesis failed to the error message
+        """
+        scripts = [script for script in dict.fromkeys(scripts) if script and not script.isspace()]
+        if not scripts:
+            return {}
+        # Looked up with get, so the cached tracks count in the hit rate and the bytes saved
+        missing = [script for script in scripts if self.tts.cache.get(self.tts.cache_key(script)) is None]
+
+        print(f"Synthesizing {len(missing)} voice tracks, {len(scripts) - len(missing)} already cached")
+        failures = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                for script, error in zip(missing, executor.map(self._synthesize_with_retries, missing)):
+                    if error is not None:
+                        failures[script] = error
+        stats = self.tts.cache.stats()
+        print(f"Voice cache: {stats['entries']} tracks, {stats['size'] / 1024 / 1024:.1f} MB, "
+              f"{stats['hit_rate']:.0%} hit rate, {stats['bytes_saved'] / 1024 / 1024:.1f} MB not downloaded again")
+        return failures
+
+    def fetch(self, script):
+        """
+        Make sure the voice of one script is on disk, with the rate limit and retries of prefetch. Can be called from
+        several threads, the rate limit is shared.
+
+        :return: None on success, the last error message otherwise
+        """
+        if not script or script.isspace() or self.tts.is_cached(script):
+            return None
+        return self._synthesize_with_retries(script)
+
+    def _synthesize_with_retries(self, script):
+        """
+        :return: None on success, the last error message otherwise
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                # Exponential backoff with jitter
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1))
+            self.rate_limiter.acquire()
+            try:
+                self.tts.synthesize(script)
+                return None
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(f"Text to speech attempt {attempt + 1}/{self.max_retries + 1} failed: {error}")
+                if not is_retryable(e):
+                    break
+        return error
+
+
 if __name__ == "__main__":
     tts = TextToSpeech()
     script_sample = "Hello, this is a test script."
@@ -0,0 +1,178 @@
+from bisect import bisect_right
+
+import numpy as np
+from moviepy.video.VideoClip import VideoClip
+
+from src import tracing
+from src.media import is_float
+
+
+def playable_duration(duration, options):
+    """
+    Duration of a video once the start given in its file name is skipped, the same way Media trims it.
+
+    :param duration: Duration of the whole video
+    :param options: Options parsed from the file name of the video
+    """
+    if "start" in options and is_float(options["start"]) and float(options["start"]) < duration:
+        return duration - float(options["start"])
+    return duration
+
+
+def media_durations(entries):
+    """
+    :param entries: MediaIndex entries of the media
+    :return: The playable duration of each media, None for images which can be shown for any duration
+    """
+    return [playable_duration(entry["duration"], entry["options"]) if entry["type"] == "video" else None
+            for entry in entries]
+
+
+def fair_share(total_duration, durations):
+    """
+    Water-filling: find the duration s such that showing every media for min(its duration, s) fills total_duration.
+    Media shorter than the fair share are shown entirely and the others split what is left.
+
+    :param total_duration: Duration to fill, in seconds
+    :param durations: Duration of each media, None for media without a length limit (images)
+    :return: The fair share, or None if the media are not long enough to fill total_duration even played entirely
+    """
+    if not durations:
+        return None
+    remaining = total_duration
+    count = len(durations)
+    for duration in sorted(d for d in durations if d is not None):
+        if duration * count >= remaining:
+            # This media and the longer ones all reach the share
+            break
+        remaining -= duration
+        count -= 1
+    if count == 0:
+        return None
+    return remaining / count
+
+
+def allocate_durations(total_duration, durations):
+    """
+    :param total_duration: Duration to fill, in seconds
+    :param durations: Duration of each media, None for images
+    :return: The duration each media is shown for. If the media are too short to fill total_duration, each one is
+        played entirely.
+    """
+    share = fair_share(total_duration, durations)
+    if share is None:
+        print("Not enough content to cover the full video")
+        return list(durations)
+    return [share if duration is None else min(duration, share) for duration in durations]
+
+
+class MediaTimeline:
+    """
+    The media track: clips played one after the other, each one starting `fade_duration` before the end of the
+    previous one and crossfading with it. At most two clips overlap, so a frame only evaluates the clips it shows,
+    whatever the number of media in the video.
+    """
+
+    def __init__(self, frame_size, fade_duration):
+        self.frame_size = tuple(frame_size)
+        self.fade_duration = fade_duration
+        self.clips = []
+        # Functions creating the clips added with add_lazy, which are only opened while they are shown
+        self.factories = []
+        self.starts = []
+        self.ends = []
+        width, height = self.frame_size
+        self._black = np.zeros((height, width, 3), dtype=np.uint8)
+        # Crossfades are blended with integer alpha in buffers reused by every frame
+        self._blend_buffer = np.empty((height, width, 3), dtype=np.uint16)
+        self._blend_other = np.empty((height, width, 3), dtype=np.uint16)
+        self._frame_buffer = np.empty((height, width, 3), dtype=np.uint8)
+
+    def add(self, clip):
+        """
+        Append a clip of the frame size at the end of the timeline.
+
+        :return: The start time of the clip
+        """
+        return self._append(clip, None, clip.duration)
+
+    def add_lazy(self, factory, duration):
+        """
+        Append a clip created by `factory` the first time one of its frames is needed, and closed once the timeline
+        is past it. A process rendering a part of the timeline only opens the media of that part.
+
+        :param factory: Function without argument returning a clip of the frame size
+        :param duration: Duration of the clip the factory returns
+        :return: The start time of the clip
+        """
+        return self._append(None, factory, duration)
+
+    def _append(self, clip, factory, duration):
+        start = 0
+        if self.starts:
+            start = max(self.starts[-1], self.ends[-1] - self.fade_duration)
+        self.clips.append(clip)
+        self.factories.append(factory)
+        self.starts.append(start)
+        self.ends.append(start + duration)
+        return start
+
+    @property
+    def duration(self):
+        return self.ends[-1] if self.ends else 0
+
+    def _clip(self, index):
+        if self.clips[index] is None:
+            # Lazy clips two places or more behind are not shown anymore, their readers are closed
+            for previous in range(index - 1):
+                if self.factories[previous] is not None and self.clips[previous] is not None:
+                    self.clips[previous].close()
+                    self.clips[previous] = None
+            self.clips[index] = self.factories[index]()
+        return self.clips[index]
+
+    def _clip_frame(self, index, t):
+        clip = self._clip(index)
+        # Never ask a clip for a frame past its end, video readers return garbage or fail there
+        local_t = min(max(0.0, t - self.starts[index]), max(0.0, clip.duration - 1e-3))
+        return clip.get_frame(local_t)[:, :, :3]
+
+    def get_frame(self, t):
+        index = bisect_right(self.starts, t) - 1
+        if index < 0 or t >= self.duration:
+            return self._black
+        frame = self._clip_frame(index, t)
+        if index == 0 or t >= self.ends[index - 1]:
+            return frame
+
+        # Crossfade: the clip fades in over the previous one
+        alpha = min(256, max(0, int(256 * (t - self.starts[index]) / self.fade_duration)))
+        previous = self._clip_frame(index - 1, t)
+        np.multiply(frame, np.uint16(alpha), out=self._blend_buffer)
+        np.multiply(previous, np.uint16(256 - alpha), out=self._blend_other)
+        self._blend_buffer += self._blend_other
+        self._blend_buffer >>= 8
+        np.copyto(self._frame_buffer, self._blend_buffer, casting="unsafe")
+        return self._frame_buffer
+
+    def to_clip(self):
+        return VideoClip(tracing.frame_timer("media_track", self.get_frame), duration=self.duration)
+
+    def segment_frames(self, count, fps):
+        """
+        Split the timeline in at most `count` parts of about the same duration, cut where a crossfade ends: each part
+        then starts on a single clip and no media is needed on both sides of a cut.
+
+        :return: The frame index of the cuts, starting with 0 and ending with the number of frames
+        """
+        n_frames = int(self.duration * fps)
+        # Where the crossfade between a clip and the next one is over
+        candidates = [int(np.ceil(end * fps - 1e-6)) for end in self.ends[:-1]]
+        cuts = [0]
+        for k in range(1, count):
+            target = k * n_frames / count
+            remaining = [c for c in candidates if cuts[-1] < c < n_frames]
+            if not remaining:
+                break
+            cuts.append(min(remaining, key=lambda c: abs(c - target)))
+        return sorted(set(cuts)) + [n_frames]
@@ -0,0 +1,285 @@
+"""
+Stage spans, per-frame timings and peak memory of a render, written as JSON and in the Chrome trace-event format
+(open the .chrome.json files in chrome://tracing or https://ui.perfetto.dev). The peak memory is recorded for the
+spans of the main thread of each process only, it is null for the spans of other threads.
+
+Tracing is enabled with enable(output_dir), or by setting the AUTO_SHORTS_TRACE environment variable to the output
+folder, which also enables it in the worker processes. When it is disabled span() returns a shared no-op context
+manager and frame_timer() returns the function it is given, so the instrumentation costs next to nothing.
+"""
+import atexit
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+ENV_VAR = "AUTO_SHORTS_TRACE"
+
+_tracer = None
+_disabled_checked = False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def read_peak_rss():
+    """
+    :return: The peak resident memory of the process since the last reset_peak_rss, in bytes, or None if unknown
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of the whole process, not of the calling thread. Linux only, elsewhere the peak of
+    a stage is the peak of the process so far.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class _Span:
+    __slots__ = ("name", "args", "start", "peak_rss")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = 0.0
+        self.peak_rss = 0
+
+
+class Tracer:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.epoch = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.frame_times = {}
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, **args):
+        stack = self._stack()
+        span = _Span(name, args)
+        # The peak memory is the one of the whole process and resetting it affects every thread: it is only measured
+        # for the spans of the main thread, spans of other threads (the stages of a pipeline) run at the same time
+        measure = threading.current_thread() is threading.main_thread()
+        if measure:
+            # The peak so far belongs to the enclosing span, then the peak is measured again for this one
+            if stack:
+                stack[-1].peak_rss = max(stack[-1].peak_rss, read_peak_rss() or 0)
+            reset_peak_rss()
+        stack.append(span)
+        span.start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            end = time.perf_counter()
+            if measure:
+                span.peak_rss = max(span.peak_rss, read_peak_rss() or 0)
+            stack.pop()
+            if stack:
+                stack[-1].peak_rss = max(stack[-1].peak_rss, span.peak_rss)
+            with self.lock:
+                self.spans.append({
+                    "name": span.name,
+                    "start": span.start - self.origin,
+                    "duration": end - span.start,
+                    "tid": threading.get_ident(),
+                    "depth": len(stack),
+                    "peak_rss_mb": span.peak_rss / 1024 / 1024 if measure else None,
+                    "args": {key: str(value) for key, value in span.args.items()},
+                })
+
+    def record_frame(self, name, seconds):
+        times = self.frame_times.get(name)
+        if times is None:
+            with self.lock:
+                times = self.frame_times.setdefault(name, array("d"))
+        times.append(seconds)
+
+    def frame_timer(self, name, function):
+        record = self.record_frame
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return timed
+
+    def histograms(self):
+        """
+        :return: For every frame function, the count and percentiles of its durations in ms, and a histogram with
+            power of two buckets (the key is the upper bound of the bucket in ms)
+        """
+        result = {}
+        for name, times in self.frame_times.items():
+            if not times:
+                continue
+            values = sorted(times)
+            count = len(values)
+            buckets = {}
+            for value in values:
+                bound = 0.125
+                while bound < value * 1000:
+                    bound *= 2
+                buckets[bound] = buckets.get(bound, 0) + 1
+            result[name] = {
+                "count": count,
+                "total_s": sum(values),
+                "mean_ms": sum(values) / count * 1000,
+                "p50_ms": values[count // 2] * 1000,
+                "p90_ms": values[min(count - 1, int(count * 0.9))] * 1000,
+                "p99_ms": values[min(count - 1, int(count * 0.99))] * 1000,
+                "max_ms": values[-1] * 1000,
+                "buckets_ms": {str(bound): n for bound, n in sorted(buckets.items())},
+            }
+        return result
+
+    def chrome_events(self):
+        events = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": f"pid {self.pid}"}}]
+        offset = (self.epoch - _trace_epoch()) * 1e6
+        for span in self.spans:
+            measured = span["peak_rss_mb"] is not None
+            args = dict(span["args"], peak_rss_mb=round(span["peak_rss_mb"], 1)) if measured else span["args"]
+            events.append({"name": span["name"], "ph": "X", "pid": self.pid, "tid": span["tid"],
+                           "ts": offset + span["start"] * 1e6, "dur": span["duration"] * 1e6, "args": args})
+            if measured:
+                events.append({"name": "peak RSS (MB)", "ph": "C", "pid": self.pid,
+                               "ts": offset + (span["start"] + span["duration"]) * 1e6,
+                               "args": {"MB": round(span["peak_rss_mb"], 1)}})
+        return events
+
+    def flush(self):
+        """
+        Write the trace of this process, <output_dir>/trace_<pid>.json and .chrome.json.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"trace_{self.pid}")
+        with self.lock:
+            summary = {"pid": self.pid, "started_at": self.epoch, "spans": list(self.spans),
+                       "frames": self.histograms()}
+            events = self.chrome_events()
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=1)
+        with open(base + ".chrome.json", "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _trace_epoch():
+    # All the processes of a run share the time origin of the first one, given to the workers in the environment
+    return float(os.environ.get(ENV_VAR + "_EPOCH", time.time()))
+
+
+def _get():
+    global _tracer, _disabled_checked
+    if _tracer is not None:
+        if _tracer.pid != os.getpid():
+            # A forked worker: start its own trace instead of writing the events of the parent again
+            _tracer = Tracer(_tracer.output_dir)
+        return _tracer
+    if not _disabled_checked:
+        _disabled_checked = True
+        if os.environ.get(ENV_VAR):
+            _tracer = Tracer(os.environ[ENV_VAR])
+            atexit.register(flush)
+    return _tracer
+
+
+def enable(output_dir):
+    """
+    Trace this process and the worker processes it starts, the traces are written in output_dir.
+    """
+    global _tracer
+    os.environ[ENV_VAR] = output_dir
+    os.environ.setdefault(ENV_VAR + "_EPOCH", str(time.time()))
+    if _get() is None:
+        _tracer = Tracer(output_dir)
+        atexit.register(flush)
+
+
+def is_enabled():
+    return _get() is not None
+
+
+def span(name, **args):
+    """
+    Context manager timing a stage: with tracing.span("alignment"): ...
+    """
+    tracer = _get()
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **args)
+
+
+def frame_timer(name, function):
+    """
+    Wrap a function called once per frame so that its durations are collected in the `name` histogram.
+    Returns the function itself when tracing is disabled.
+    """
+    tracer = _get()
+    if tracer is None:
+        return function
+    return tracer.frame_timer(name, function)
+
+
+def flush():
+    """
+    Write the trace of this process. Worker processes do not run atexit handlers, they flush after each job.
+    """
+    tracer = _get()
+    if tracer is not None:
+        tracer.flush()
+
+
+def merge(output_dir):
+    """
+    Merge the Chrome traces of all the processes in output_dir into trace.chrome.json.
+
+    :return: The path of the merged trace
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "trace_*.chrome.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            events.extend(json.load(f)["traceEvents"])
+    merged_path = os.path.join(output_dir, "trace.chrome.json")
+    with open(merged_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return merged_path
@@ -0,0 +1,148 @@
+import atexit
+import json
+import os
+import threading
+import time
+from hashlib import sha256
+
+from src.utils import get_config, atomic_write, atomic_write_json, file_lock
+
+
+class TTSCache:
+    """
+    Synthesized voice tracks keyed by (text, voice, model, format).
+
+    A manifest records the size, creation and last use time of every file. Files are written to a temporary file then
+    renamed, so an interrupted write never leaves a truncated track behind, and the least recently used tracks are
+    evicted once the cache is larger than `max_bytes`.
+
+    The manifest is shared by the processes of a run, it is merged and written under a file lock. Cache hits only
+    update the last use time in memory, it is written every FLUSH_HITS hits, with the next new track, or by flush().
+    """
+    MANIFEST = "manifest.json"
+    FLUSH_HITS = 50
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        config = get_config()
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(config.audio_dir, "tts_cache")
+        self.max_bytes = max_bytes if max_bytes is not None else config.tts_cache_max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.entries = self._read_manifest()
+        self._removed = set()
+        self._unsaved_hits = 0  # Hits whose last use time is not in the manifest on disk yet
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(text, voice, model, audio_format="mp3"):
+        return sha256(json.dumps([text, voice, model, audio_format]).encode("utf-8")).hexdigest()
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, self.MANIFEST)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self, keep=None):
+        # Other processes may have added tracks since the manifest was read: merge with the manifest on disk, under a
+        # lock so that processes writing at the same time do not drop the tracks of each other
+        with file_lock(self._manifest_path() + ".lock"):
+            entries = self._read_manifest()
+            for key, entry in self.entries.items():
+                if key in entries:
+                    entry["last_used"] = max(entry["last_used"], entries[key]["last_used"])
+                entries[key] = entry
+            for key in self._removed:
+                entries.pop(key, None)
+            self.entries = {key: entry for key, entry in entries.items()
+                            if os.path.isfile(os.path.join(self.cache_dir, entry["file"]))}
+            self._evict(keep)
+            atomic_write_json(self._manifest_path(), self.entries)
+            # Tracks removed by this write may be added again later, by this process or another one
+            self._removed.clear()
+        self._unsaved_hits = 0
+
+    def flush(self):
+        """
+        Write the last use times of the cache hits not written yet. Worker processes exit without running atexit
+        handlers, they flush after each job.
+        """
+        with self.lock:
+            if self._unsaved_hits:
+                self._write_manifest()
+
+    def _is_valid(self, entry):
+        path = os.path.join(self.cache_dir, entry["file"])
+        return os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and self._is_valid(entry)
+
+    def get(self, key):
+        """
+        :return: The path of the cached track, or None if it is not in the cache
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not self._is_valid(entry):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += entry["size"]
+            entry["last_used"] = time.time()
+            self._unsaved_hits += 1
+            if self._unsaved_hits >= self.FLUSH_HITS:
+                self._write_manifest()
+            return os.path.join(self.cache_dir, entry["file"])
+
+    def put(self, key, data, audio_format="mp3"):
+        """
+        Store a track and evict the least recently used ones if the cache is over budget.
+
+        :return: The path of the stored track
+        """
+        file_name = f"{key}.{audio_format}"
+        path = os.path.join(self.cache_dir, file_name)
+        atomic_write(path, data)
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {"file": file_name, "size": len(data), "created": now, "last_used": now}
+            self._removed.discard(key)
+            self._write_manifest(keep=key)
+        return path
+
+    def _evict(self, keep=None):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, entry["file"]))
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            self._removed.add(key)
+        for key in self._removed:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "entries": len(self.entries),
+                "size": sum(entry["size"] for entry in self.entries.values()),
+            }
@@ -3,14 +3,16 @@ import os
 
 from src.csv_reader import CSVReader
 from src.uploader_utils import upload_youtube_video, upload_to_tiktok, upload_to_meta
-from src.utils import Config
+from src.utils import get_config
 
 
 class Uploader:
-    def __init__(self, video_entry):
+    def __init__(self, video_entry, file_path=None):
         self.video_entry = video_entry
-        self.config = Config()
-        self.file_path = os.path.join(self.config.video_dir, self.video_entry.filename + ".mp4")
+        self.config = get_config()
+        # The rendered video, named after the media folder of the entry by default
+        self.file_path = file_path if file_path is not None else os.path.join(self.config.video_dir,
+                                                                              self.video_entry.filename + ".mp4")
 
     def upload_to_youtube(self, schedule=False, schedule_day="2023-09-14", schedule_time="01:30"):
         # File path
@@ -17,7 +17,7 @@ from selenium.webdriver.common.keys import Keys
 from selenium.common.exceptions import NoSuchElementException
 import autoit
 
-from src.utils import Config
+from src.utils import get_config
 
 RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError)
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
@@ -62,7 +62,7 @@ def upload_youtube_video(file_path, client_secret_path, title=" ", description="
     options.add_argument("--disable-web-security")
     options.add_argument(
         "--disable-features=CrossSiteDocumentBlockingIfIsolating,CrossSiteDocumentBlockingAlways,IsolateOrigins,site-per-process")
-    config = Config()
+    config = get_config()
     options.add_argument(f"--user-data-dir={config.user_data_dir}")
     # provide the profile name with which we want to open browser
     options.add_argument(rf'--profile-directory={config.user_profile_dir_youtube}')
@@ -216,7 +216,7 @@ def upload_to_tiktok(file_path, description, schedule=True, schedule_day="13", s
     options.add_argument("--disable-web-security")
     options.add_argument(
         "--disable-features=CrossSiteDocumentBlockingIfIsolating,CrossSiteDocumentBlockingAlways,IsolateOrigins,site-per-process")
-    config = Config()
+    config = get_config()
     options.add_argument(f"--user-data-dir={config.user_data_dir}")
 
     # provide the profile name with which we want to open browser
@@ -335,7 +335,7 @@ def upload_to_meta(file_path, description, schedule=True, schedule_day="13", sch
     options.add_argument("--disable-web-security")
     options.add_argument(
         "--disable-features=CrossSiteDocumentBlockingIfIsolating,CrossSiteDocumentBlockingAlways,IsolateOrigins,site-per-process")
-    config = Config()
+    config = get_config()
     options.add_argument(f"--user-data-dir={config.user_data_dir}")
 
     # provide the profile name with which we want to open browser
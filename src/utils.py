@@ -1,9 +1,15 @@
 import os
+import tempfile
+from collections.abc import Mapping
+from contextlib import contextmanager
+from types import MappingProxyType
 
 from pydub import AudioSegment
 import numpy as np
 import wave
 
+from src.audio_mixer import AudioMixer, proportion_to_gain
+
 import json
 
 def load_config():
@@ -23,15 +29,61 @@ def load_config():
     return config
 
 
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {key: _thaw(item) for key, item in value.items()}
+    return value
+
 
 class Config:
-    def __init__(self):
+    """
+    The settings of config/settings.json, overwritten by the ones of config/settings_private.json.
+
+    A Config is read-only. get_config() returns the one of the process, the settings files are only read once, and
+    with_overrides() returns a copy with some settings of a single video changed.
+    """
+    __slots__ = (
+        "elevenlabs_api_key", "elevenlabs_voice", "elevenlabs_model", "tts_max_concurrency", "tts_requests_per_second",
+        "tts_burst", "tts_max_retries", "tts_backoff_base", "tts_backoff_max", "tts_cache_max_mb", "youtube_id",
+        "youtube_secret_key", "frame_size", "fps", "music_proportion", "music_fade_in", "music_fade_out", "duck_db",
+        "duck_threshold_db", "subtitle_pos", "subtitle_nb_word", "subtitle_nb_word_per_line", "subtitle_font",
+        "subtitle_font_size", "fade_duration", "show_title", "time_title", "title_font_size", "background_title",
+        "background_title_opacity", "color_title", "title_nb_word_per_line", "encoding_profile", "encoding_profiles",
+        "encoding_queue_size", "encoding_segments", "draft_scale", "draft_fps", "draft_profile", "proxy_enabled",
+        "proxy_crf", "proxy_preset", "pipeline_mix_workers", "pipeline_align_workers", "pipeline_queue_size",
+        "pipeline_sample_interval", "job_store_path", "job_store_lease", "audio_dir", "image_dir", "video_dir",
+        "music_dir", "config_dir", "user_data_dir", "user_profile_dir_tiktok", "user_profile_dir_fb",
+        "user_profile_dir_youtube", "fb_asset_id", "fb_business_id", "youtube_channel_id", "aligned_dir", "cache_dir",
+        "csv_path", "is_header_row", "acoustic_model_path", "dict_model_path",
+        "_frozen",
+    )
+
+    def __init__(self, settings=None):
+        """
+        :param settings: The parsed settings, read from the settings files if None
+        """
         try:
-            settings = load_config()
+            settings = settings if settings is not None else load_config()
             self.elevenlabs_api_key = settings["api"]["eleven_labs"]["API_KEY"]
             self.elevenlabs_voice = settings["api"]["eleven_labs"]["voice"]
             self.elevenlabs_model = settings["api"]["eleven_labs"]["model"]
 
+            self.tts_max_concurrency = settings["tts"]["max_concurrency"]
+            self.tts_requests_per_second = settings["tts"]["requests_per_second"]
+            self.tts_burst = settings["tts"]["burst"]
+            self.tts_max_retries = settings["tts"]["max_retries"]
+            self.tts_backoff_base = settings["tts"]["backoff_base"]
+            self.tts_backoff_max = settings["tts"]["backoff_max"]
+            self.tts_cache_max_mb = settings["tts"]["cache_max_mb"]
+
             self.youtube_id = settings["api"]["youtube"]["id"]
             self.youtube_secret_key = settings["api"]["youtube"]["secret_key"]
 
@@ -39,6 +91,11 @@ class Config:
             self.fps = settings["video_settings"]["fps"]
             self.music_proportion = settings["video_settings"]["music_proportion"]
 
+            self.music_fade_in = settings["audio"]["music_fade_in"]
+            self.music_fade_out = settings["audio"]["music_fade_out"]
+            self.duck_db = settings["audio"]["duck_db"]
+            self.duck_threshold_db = settings["audio"]["duck_threshold_db"]
+
             self.subtitle_pos = settings["video_settings"]["subtitle"]["y_pos"]
             self.subtitle_nb_word = settings["video_settings"]["subtitle"]["nb_word"]
             self.subtitle_nb_word_per_line = settings["video_settings"]["subtitle"]["nb_word_per_line"]
@@ -54,6 +111,27 @@ class Config:
             self.color_title = settings["video_settings"]["title"]["color"]
             self.title_nb_word_per_line = settings["video_settings"]["title"]["nb_word_per_line"]
 
+            self.encoding_profile = settings["encoding"]["profile"]
+            self.encoding_profiles = settings["encoding"]["profiles"]
+            self.encoding_queue_size = settings["encoding"]["queue_size"]
+            self.encoding_segments = settings["encoding"]["segments"]
+
+            self.draft_scale = settings["draft"]["scale"]
+            self.draft_fps = settings["draft"]["fps"]
+            self.draft_profile = settings["draft"]["profile"]
+
+            self.proxy_enabled = settings["proxy"]["enabled"]
+            self.proxy_crf = settings["proxy"]["crf"]
+            self.proxy_preset = settings["proxy"]["preset"]
+
+            self.pipeline_mix_workers = settings["pipeline"]["mix_workers"]
+            self.pipeline_align_workers = settings["pipeline"]["align_workers"]
+            self.pipeline_queue_size = settings["pipeline"]["queue_size"]
+            self.pipeline_sample_interval = settings["pipeline"]["sample_interval"]
+
+            self.job_store_path = settings["job_store"]["path"]
+            self.job_store_lease = settings["job_store"]["lease_seconds"]
+
             self.audio_dir = settings["directories"]["audio_dir"]
             self.image_dir = settings["directories"]["image_dir"]
             self.video_dir = settings["directories"]["video_dir"]
@@ -69,6 +147,7 @@ class Config:
             self.youtube_channel_id = settings["selenium"]["youtube_channel_id"]
 
             self.aligned_dir = settings["directories"]["aligned_dir"]
+            self.cache_dir = settings["directories"]["cache_dir"]
 
             self.csv_path = settings["input_files"]["csv_path"]
             self.is_header_row = settings["input_files"]["is_header_row"]
@@ -76,66 +155,253 @@ class Config:
             self.acoustic_model_path = settings["alignment_model"]["acoustic_model_path"]
             self.dict_model_path = settings["alignment_model"]["dict_model_path"]
 
+            self._validate()
         except FileNotFoundError:
             print(f"Configuration file not found.")
         except KeyError as e:
             print(f"Missing key in configuration file: {e}")
+        except ValueError:
+            raise
         except Exception as e:
             print(f"An error occurred while reading the configuration file: {e}")
+        self.encoding_profiles = _freeze(getattr(self, "encoding_profiles", {}))
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"Config is read-only, use with_overrides() to change {name}")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        # Sent to the worker processes with the overrides of the job, without reading the settings files there
+        return Config._from_fields, (self.fields(),)
+
+    def fields(self):
+        """
+        :return: The settings as a dict of field name to value
+        """
+        return {name: _thaw(getattr(self, name)) for name in self.__slots__[:-1] if hasattr(self, name)}
+
+    @classmethod
+    def _from_fields(cls, fields):
+        config = object.__new__(cls)
+        for name, value in fields.items():
+            object.__setattr__(config, name, _freeze(value))
+        # An override of the title background can be given like in the settings file, "r,g,b"
+        if isinstance(config.background_title, str):
+            object.__setattr__(config, "background_title", tuple(map(int, config.background_title.split(','))))
+        config._validate()
+        object.__setattr__(config, "_frozen", True)
+        return config
+
+    def with_overrides(self, overrides=None, **fields):
+        """
+        Layer settings over this config, e.g. the ones of a CSV row. Layers are stacked by calling this method on
+        the result, nothing is read from disk.
+
+        :param overrides: A dict of field name to value, e.g. {"subtitle_font_size": 80}
+        :param fields: More overrides as keyword arguments
+        :return: A new Config, or this one when there is nothing to override
+        """
+        overrides = dict(overrides or {}, **fields)
+        if not overrides:
+            return self
+        unknown = [name for name in overrides if name not in self.__slots__[:-1]]
+        if unknown:
+            raise KeyError(f"Unknown settings: {', '.join(unknown)}")
+        for name, value in overrides.items():
+            self._check_type(name, value)
+        return Config._from_fields(dict(self.fields(), **overrides))
+
+    def _check_type(self, name, value):
+        """
+        :raise ValueError: If the override `value` of the field `name` does not have the type of its current value
+        """
+        current = getattr(self, name, None)
+        if current is None:
+            return
+        if name == "background_title":
+            # Also given like in the settings file, "r,g,b"
+            expected = (list, tuple, str)
+        elif isinstance(current, bool):
+            expected = bool
+        elif isinstance(current, (int, float)):
+            expected = (int, float)
+        elif isinstance(current, (list, tuple)):
+            expected = (list, tuple)
+        elif isinstance(current, Mapping):
+            expected = Mapping
+        else:
+            expected = type(current)
+        # bool is an int in Python, a number setting given true or false is a mistake
+        if not isinstance(value, expected) or (isinstance(value, bool) and not isinstance(current, bool)):
+            kind = "number" if expected == (int, float) else type(current).__name__
+            raise ValueError(f"Invalid {name} {value!r}, it must be a {kind}")
+
+    def _validate(self):
+        width, height = self.frame_size
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid frame_size {self.frame_size}")
+        for name in ("fps", "subtitle_font_size", "title_font_size", "subtitle_nb_word", "subtitle_nb_word_per_line",
+                     "title_nb_word_per_line", "draft_scale", "draft_fps", "encoding_segments",
+                     "pipeline_mix_workers", "pipeline_align_workers", "pipeline_queue_size", "tts_max_concurrency",
+                     "tts_requests_per_second", "tts_burst"):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"Invalid {name} {getattr(self, name)}, it must be positive")
+        for name in ("tts_max_retries", "tts_backoff_base", "tts_backoff_max"):
+            if getattr(self, name) < 0:
+                raise ValueError(f"Invalid {name} {getattr(self, name)}, it must not be negative")
+        if not 0 <= self.music_proportion <= 1:
+            raise ValueError(f"Invalid music_proportion {self.music_proportion}, it must be between 0 and 1")
+        for name in ("encoding_profile", "draft_profile"):
+            if getattr(self, name) not in self.encoding_profiles:
+                raise ValueError(f"Unknown encoding profile {getattr(self, name)} for {name}")
+
+
+_config = None
+
+
+def get_config():
+    """
+    :return: The Config of this process, the settings files are read on the first call only
+    """
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
 
 
-def generate_save_path(audio1, audio2, extension="mp3"):
+def generate_save_path(audio1, audio2, extension="mp3", save_dir=None):
     """
     Generate a save path based on the filenames of two audio objects.
 
     :param audio1: The first Audio object
     :param audio2: The second Audio object
     :param extension: The file extension for the new audio file
+    :param save_dir: Directory for the new file, defaults to the directory of the first audio
     :return: A string representing the new save path
     """
-    # Get the directory and filenames
-    dir1, filename1_with_extension = os.path.split(audio1.file_path)
-    dir2, filename2_with_extension = os.path.split(audio2.file_path)
-
-    # Get the filenames without extensions
-    filename1, _ = os.path.splitext(filename1_with_extension)
-    filename2, _ = os.path.splitext(filename2_with_extension)
-
     # Generate the new filename and save path
-    new_filename = f"{filename1}_{filename2}.{extension}"
-    new_save_path = os.path.join(dir1, new_filename)
+    new_filename = f"{audio1.name}_{audio2.name}.{extension}"
+    new_save_path = os.path.join(save_dir if save_dir is not None else os.path.dirname(audio1.file_path),
+                                 new_filename)
 
     return new_save_path
 
 
+# numpy dtype of the samples for each pydub sample width
+SAMPLE_WIDTH_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
 class Audio:
-    def __init__(self, file_path=None, data=None, audio_segment=None):
-        if audio_segment is None:
-            audio_segment = AudioSegment.from_mp3(os.path.abspath(file_path))
-        if data is None:
-            data = audio_segment.raw_data
-
-        if file_path is None:
-            # Save the audio segment to the temporary file
-            audio_folder = Config().audio_dir
-            file_path = audio_folder + "temp.wav"
-
-            audio_segment.export(file_path, format="wav")
-        self.audio_segment = audio_segment
-        self.data = data  # The binary audio data
-        self.file_path = file_path  # The path to the audio file
+    """
+    Audio is decoded lazily, the first time its samples or segment are needed, and a file is only written when a
+    consumer asks for file_path on an audio that only exists in memory.
+    """
+
+    def __init__(self, file_path=None, data=None, audio_segment=None, scratch_dir=None):
+        if file_path is None and audio_segment is None:
+            raise ValueError("An Audio needs a file path or an audio segment")
+        self._file_path = file_path  # The path to the audio file
+        self._data = data  # The binary audio data, as given by the caller (e.g. the mp3 bytes)
+        self._audio_segment = audio_segment
+        # PCM samples and their rate, for audio built from a NumPy buffer (see from_samples)
+        self._samples = None
+        self._sample_rate = None
+        # Where the audio is written if a path is needed, in the job's scratch dir when running in a batch
+        self.scratch_dir = scratch_dir
+
+    @classmethod
+    def from_samples(cls, samples, sample_rate, file_path=None, scratch_dir=None):
+        """
+        Create an Audio backed by a NumPy buffer of int16 samples of shape (n_samples, n_channels).
+        If file_path is given, the samples are written there as a WAV.
+        """
+        audio = cls.__new__(cls)
+        audio._file_path = None
+        audio._data = None
+        audio._audio_segment = None
+        audio._samples = samples
+        audio._sample_rate = sample_rate
+        audio.scratch_dir = scratch_dir
+        if file_path is not None:
+            audio._write_wav(file_path)
+        return audio
+
+    def _write_wav(self, file_path):
+        save_wav(memoryview(np.ascontiguousarray(self._samples)).cast("B"), file_path, n_channels=self._samples.shape[1],
+                 sampwidth=self._samples.dtype.itemsize, framerate=self._sample_rate)
+        self._file_path = file_path
+
+    @property
+    def audio_segment(self):
+        if self._audio_segment is None:
+            if self._samples is not None:
+                self._audio_segment = AudioSegment(data=np.ascontiguousarray(self._samples).tobytes(),
+                                                   sample_width=self._samples.dtype.itemsize,
+                                                   frame_rate=self._sample_rate, channels=self._samples.shape[1])
+            else:
+                self._audio_segment = AudioSegment.from_file(os.path.abspath(self._file_path))
+        return self._audio_segment
+
+    @property
+    def data(self):
+        if self._data is None:
+            return self.audio_segment.raw_data
+        return self._data
+
+    @property
+    def file_path(self):
+        if self._file_path is None:
+            # Save the audio segment to a temporary file
+            audio_folder = self.scratch_dir if self.scratch_dir is not None else get_config().audio_dir
+            os.makedirs(audio_folder, exist_ok=True)
+            fd, file_path = tempfile.mkstemp(prefix="temp_", suffix=".wav", dir=audio_folder)
+            os.close(fd)
+            if self._samples is not None:
+                self._write_wav(file_path)
+            else:
+                self.audio_segment.export(file_path, format="wav")
+                self._file_path = file_path
+        return self._file_path
+
+    @property
+    def name(self):
+        # Name of the audio file without extension, without writing the file if there is none yet
+        if self._file_path is None:
+            return "audio"
+        return os.path.splitext(os.path.basename(self._file_path))[0]
+
+    def get_samples(self):
+        """
+        :return: The PCM samples as a read-only (n_samples, n_channels) view over the decoded buffer, without copy
+        """
+        if self._samples is not None:
+            return self._samples
+        segment = self.audio_segment
+        samples = np.frombuffer(segment.raw_data, dtype=SAMPLE_WIDTH_DTYPES[segment.sample_width])
+        return samples.reshape(-1, segment.channels)
 
     def get_audio_np_array(self):
+        samples = self.get_samples()
+        if samples.shape[1] == 1:
+            return samples[:, 0]
         # Convert to single channel (mono)
-        audio = self.audio_segment.set_channels(1)
+        return samples.mean(axis=1).astype(samples.dtype)
 
-        # Convert to numpy array
-        return np.array(audio.get_array_of_samples())
+    def get_duration(self):
+        # Duration in seconds
+        if self._samples is not None:
+            return len(self._samples) / self._sample_rate
+        return self.audio_segment.duration_seconds
 
     def get_sample_rate(self):
+        if self._samples is not None:
+            return self._sample_rate
         return self.audio_segment.frame_rate
 
-    def overlay_audio(self, other_audio, position_ms=0, proportion1=0.9, proportion2=0.1, save_audio=True):
+    def overlay_audio(self, other_audio, position_ms=0, proportion1=0.9, proportion2=0.1, save_audio=True,
+                      save_dir=None, mixer=None):
         """
         Overlay another audio onto this audio.
 
@@ -143,34 +409,24 @@ class Audio:
         :param position_ms: Position where the new audio will be overlaid on the original audio
         :param proportion1: Proportion of the first audio in the overlay
         :param proportion2: Proportion of the second audio in the overlay
+        :param save_dir: Directory where the overlaid audio is written, defaults to next to this audio
+        :param mixer: The AudioMixer applying fades and ducking, configured from the settings by default
         :return: A new Audio object containing the overlaid audio
         """
         if other_audio is None:
             return self
-        # Make sure both audio segments have the same frame rate
-
-        if self.get_sample_rate() != other_audio.get_sample_rate():
-            other_audio.audio_segment.set_frame_rate(self.audio_segment.frame_rate)
-
-            #raise ValueError("Both audio segments must have the same frame rate for overlay.")
-
-        # Cut the second audio to the same length as the first
-        other_audio_segment = other_audio.audio_segment[:len(self.audio_segment)]
+        mixer = mixer if mixer is not None else AudioMixer.from_config(get_config())
 
-        # Scale the audio segments based on the given proportions
-        self_adjusted = self.audio_segment - (1 - proportion1) * 20
-        other_adjusted = other_audio_segment - (1 - proportion2) * 20
+        # The other audio is resampled to the rate of this one and cut to the same length
+        samples = mixer.mix(self.get_samples(), self.get_sample_rate(),
+                            other_audio.get_samples(), other_audio.get_sample_rate(),
+                            voice_gain=proportion_to_gain(proportion1), music_gain=proportion_to_gain(proportion2),
+                            position_ms=position_ms)
 
-        # Overlay the audio segments
-        overlaid_audio_segment = self_adjusted.overlay(other_adjusted, position=position_ms)
-        new_audio_path = generate_save_path(self, other_audio, extension="wav")
-
-        if save_audio:
-            overlaid_audio_segment.export(new_audio_path, format="wav")
         # Create a new Audio object for the overlaid audio
-        overlaid_audio = Audio(new_audio_path, audio_segment=overlaid_audio_segment)
-
-        return overlaid_audio
+        new_audio_path = generate_save_path(self, other_audio, extension="wav", save_dir=save_dir)
+        return Audio.from_samples(samples, self.get_sample_rate(), file_path=new_audio_path if save_audio else None,
+                                  scratch_dir=save_dir)
 
 
 def save_wav(audio_bytes, filename, n_channels=1, sampwidth=2, framerate=44100):
@@ -179,3 +435,60 @@ def save_wav(audio_bytes, filename, n_channels=1, sampwidth=2, framerate=44100):
         wav_file.setsampwidth(sampwidth)
         wav_file.setframerate(framerate)
         wav_file.writeframes(audio_bytes)
+
+
+def atomic_write(path, data):
+    """
+    Write bytes to a file atomically: they are written to a temporary file in the same folder which is then renamed,
+    so a crash never leaves a truncated file at `path`.
+
+    :param path: The destination path
+    :param data: The bytes to write
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path, obj):
+    atomic_write(path, json.dumps(obj).encode("utf-8"))
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on the file `path`, created if missing, waiting while another process holds it. Used around
+    read-modify-write of files shared by the worker processes.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # Retries for 10 seconds, then raises
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -1,44 +1,24 @@
 import os
 import queue
+import shutil
+import tempfile
 from collections import defaultdict
-
-import numpy as np
-from moviepy.editor import AudioFileClip
-from moviepy.editor import CompositeVideoClip
-from moviepy.video.fx import all as vfx
-from moviepy.editor import VideoFileClip
-from PIL import Image, ImageDraw, ImageFont
-
-from moviepy.video.VideoClip import TextClip, ColorClip, ImageClip
-
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from src import tracing
+from src.alignment_cache import AlignmentCache
+from src.audio_mixer import AudioMixer
+from src.compositor import OverlayCompositor
+from src.encoder import EncoderProfile, StreamingEncoder, concat_segments
 from src.media import Media
-from src.utils import Config, Audio  # Import the Config class from utils module
-import pyfoal
+from src.text_renderer import TextRenderer
+from src.media_index import MediaIndex
+from src.timeline import MediaTimeline, allocate_durations, media_durations
+from src.utils import get_config, Audio  # The settings, loaded once per process
 import re
 
 
-def create_emoji_image_clip(emoji, font_size):
-    # Create an image with transparent background
-    image = Image.new("RGBA", (font_size, font_size), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(image)
-
-    # Set the font and size
-    try:
-        font = ImageFont.truetype(os.path.abspath("resources/seguiemj.ttf"),
-                                  font_size)  # Replace with the path to a TTF/OTF font file that supports emoji
-    except IOError:
-        print("Error while loading the font")
-        font = ImageFont.truetype("arial.ttf", font_size)
-
-    # Draw the emoji
-    draw.text((0, 0), emoji, font=font, fill=(255, 255, 255, 255), embedded_color=True)
-
-    # Create an ImageClip
-    emoji_clip = ImageClip(np.array(image))  # 5 seconds duration, adjust as needed
-
-    return emoji_clip
-
-
 def extract_and_remove_emojis(text):
     emoji_pattern = re.compile(r'[^\x00-\x7F]+', flags=re.UNICODE)
 
@@ -52,8 +32,27 @@ def extract_and_remove_emojis(text):
     return text_without_emojis, emojis_positions
 
 
-def get_alignement(text, audio_object):
-    return pyfoal.align(text, audio_object.get_audio_np_array(), audio_object.get_sample_rate()).json()
+def get_alignement(text, audio_object, cache=None, refresh=False):
+    """
+    Align the text on the audio, reusing a cached alignment of the same text and audio when there is one.
+
+    :param text: The script, without emojis
+    :param audio_object: The voice Audio object
+    :param cache: The AlignmentCache to use, defaults to one in the configured aligned_dir
+    :param refresh: Ignore the cached alignment and compute it again
+    :return: The alignment as a dict
+    """
+    cache = cache if cache is not None else AlignmentCache()
+    samples = audio_object.get_audio_np_array()
+    sample_rate = audio_object.get_sample_rate()
+    key = cache.key(text, samples, sample_rate)
+    if not refresh and (alignment := cache.get(key)) is not None:
+        return alignment
+    # Imported here so that cached alignments (and the benchmarks) do not need pyfoal and HTK installed
+    import pyfoal
+    alignment = pyfoal.align(text, samples, sample_rate).json()
+    cache.put(key, alignment)
+    return alignment
 
 
 def create_index_mapping(cleaned_text, original_text):
@@ -157,98 +156,228 @@ def match_aligned_words_to_text(filtered_aligned_words, original_text, extracted
     return word_aligned2text
 
 
+def video_file_path(video_dir, filename, draft=False):
+    return os.path.join(video_dir, filename + ("_draft" if draft else "") + ".mp4")
+
+
+def load_media_clip(path, duration, options, frame_size, fps, config=None):
+    media = Media(path, duration, options=options, frame_size=frame_size, fps=fps, config=config)
+    media.set_duration(duration)
+    return media.clip
+
+
+class VideoPlan:
+    """
+    Everything needed to render the frames of a video: the media and their durations, the alignment of the script
+    and the output settings. It is sent to the processes rendering the segments of the video.
+    """
+
+    def __init__(self):
+        self.media_folder = None
+        self.media_paths = []
+        self.media_options = []
+        self.durations = []
+        self.fade_duration = 0
+        self.audio_path = None  # The mixed voice and music
+        self.script = ""
+        self.title = ""
+        self.script_without_emojis = ""
+        self.extracted_emojis = []
+        self.alignment = None
+        self.frame_size = None
+        self.fps = None
+        self.profile = None
+        self.config = None  # The settings of the video, with the overrides of its job
+
+
+def render_segment(plan, start_frame, end_frame, output_path):
+    """
+    Encode the frames from start_frame to end_frame of a planned video, without audio. Runs in a worker process.
+    """
+    try:
+        with tracing.span("render_segment", start_frame=start_frame, end_frame=end_frame):
+            generator = VideoGeneration(plan.media_folder, config=plan.config)
+            encoder = StreamingEncoder(output_path, plan.frame_size, plan.fps, plan.profile,
+                                       queue_size=generator.config.encoding_queue_size)
+            return encoder.encode(generator.build_clip(plan), start_frame=start_frame, end_frame=end_frame)
+    finally:
+        # Worker processes exit without running atexit handlers
+        tracing.flush()
+
+
 class VideoGeneration:
-    def __init__(self, media_folder=None):
-        self.config = Config()
+    def __init__(self, media_folder=None, scratch_dir=None, refresh_alignment=False, config=None):
+        """
+        :param config: The Config of the videos, e.g. with the overrides of a CSV row, get_config() by default
+        """
+        self.config = config if config is not None else get_config()
         self.video_dir = self.config.video_dir
         self.frame_size = self.config.frame_size
         self.media_folder = media_folder if media_folder is not None else self.config.image_dir
         self.fps = self.config.fps
-
-    def generate_video(self, audio_object, script, title, filename, music_object=None):
-        # Get all files from the media folder
-        all_files = os.listdir(self.media_folder)
+        # Where intermediate files (mixed audio) are written, so parallel jobs do not overwrite each other
+        self.scratch_dir = scratch_dir
+        # Recompute the forced alignment instead of using the cached one
+        self.refresh_alignment = refresh_alignment
+        self.alignment_cache = AlignmentCache(self.config.aligned_dir)
+        # Subtitle words are rasterized in-process and cached across the videos rendered by this generator
+        self.text_renderer = TextRenderer()
+
+    def output_settings(self, draft=False):
+        """
+        :param draft: Render a low resolution, low fps preview with the fastest encoder settings
+        :return: The frame size, the fps and the EncoderProfile of the video
+        """
+        if not draft:
+            profile = EncoderProfile.from_config(self.config)
+            return self.frame_size, profile.fps or self.fps, profile
+        width, height = self.frame_size
+        # Even dimensions for yuv420p
+        frame_size = (max(2, int(width * self.config.draft_scale) // 2 * 2),
+                      max(2, int(height * self.config.draft_scale) // 2 * 2))
+        profile = EncoderProfile.from_config(self.config, self.config.draft_profile)
+        return frame_size, profile.fps or self.config.draft_fps, profile
+
+    def mix_audio(self, audio_object, music_object=None):
+        """
+        :return: The Audio of the video, the voice with the music bed, written in scratch_dir
+        """
+        with tracing.span("overlay_audio"):
+            return audio_object.overlay_audio(music_object,
+                                              proportion1=1 - self.config.music_proportion,
+                                              proportion2=self.config.music_proportion,
+                                              save_dir=self.scratch_dir,
+                                              mixer=AudioMixer.from_config(self.config))
+
+    def align_script(self, script, audio_object):
+        """
+        :return: The alignment of the script, without its emojis, on the voice
+        """
+        script_without_emojis, _ = extract_and_remove_emojis(script)
+        with tracing.span("alignment"):
+            return get_alignement(script_without_emojis, audio_object, self.alignment_cache, self.refresh_alignment)
+
+    def plan_video(self, audio_object, script, title, music_object=None, draft=False, video_audio=None,
+                   alignment=None):
+        """
+        Do everything that is done once per video: mix the audio, allocate the media durations and align the script.
+
+        :param video_audio: The Audio already returned by mix_audio, mixed here if None
+        :param alignment: The alignment already returned by align_script, computed here if None
+        :return: The VideoPlan the frames are rendered from
+        """
+        frame_size, fps, profile = self.output_settings(draft)
+        # Media and their metadata, only the new or modified files of the folder are probed
+        with tracing.span("media_index"):
+            media_entries = MediaIndex(self.media_folder).refresh()
         fade_duration = self.config.fade_duration
-        media_files = sorted([f for f in all_files if f.lower().endswith(('.png', '.jpg', '.jpeg',
-                                                                          '.mp4', '.avi', '.mov'))])
-        video_files = [f for f in all_files if f.lower().endswith(('.mp4', '.avi', '.mov'))]
-        image_files = [f for f in all_files if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        media_files = list(media_entries)
+        if not media_files:
+            raise ValueError(f"No media file in {self.media_folder}")
         # Set the audio of the video clip
-        video_audio = audio_object.overlay_audio(music_object,
-                                                 proportion1=1 - self.config.music_proportion,
-                                                 proportion2=self.config.music_proportion)
-
-        audio_clip = AudioFileClip(video_audio.file_path)
-        # Calculate the duration each media should be displayed to match the audio length
-        audio_duration = audio_clip.duration + (fade_duration * (len(media_files) - 1))  # Assuming audio is 44.1 kHz
-        # Initial estimate
-        total_media_count = len(media_files)
-        media_duration = audio_duration / total_media_count
-        video_path2video = {}
-        for video_file in video_files:
-            video_path = os.path.join(self.media_folder, video_file)
-            video_clip = VideoFileClip(video_path)
-            video_path2video[video_file] = video_clip
-        while True:
-            total_video_duration = 0
-            video_with_more_time = 0
-            for video in video_path2video.values():
-                total_video_duration += min(media_duration, video.duration)
-                if media_duration <= video.duration:
-                    video_with_more_time += 1
-            try:
-                updated_media_duration = (
-                    (audio_duration - total_video_duration) / len(image_files) if len(image_files) > 0
-                    else (audio_duration - total_video_duration
-                          + video_with_more_time * media_duration)
-                         / video_with_more_time)
-            except:
-                print("Not enough content to cover the full video")
-                break
-
-            if abs(media_duration - updated_media_duration) < 0.01:  # Convergence criteria
-                break
-            media_duration = (media_duration + updated_media_duration) / 2
-
-        clips = []
-        last_end = 0
-        clip_start = 0
-        for i, media_path in enumerate(media_files):
-            media = Media(os.path.join(self.media_folder, media_path), media_duration,
-                          video_path2video[media_path] if media_path in video_path2video else None)
-            media.set_duration(media_duration)
-            if i != len(media_files) - 1:
-                # Make the first clip fade out
-                media.add_transition("crossfadeout", fade_duration)
-            if i > 0:
-                clip_start = last_end - fade_duration
-                # Make the second clip fade in
-                media.add_transition("crossfadein", fade_duration)
-            # Shift the second clip's start time back by `fade_duration` to make it
-            # start fading in before the first clip ends
-            media.set_start(clip_start)
-            last_end = clip_start + media.get_duration()
-            clips.append(media.clip.set_position(('center', 'center')))
-        # Concatenate all the clips together
-        final_clip = CompositeVideoClip(clips)
-        # Resize the video
-        final_clip = final_clip.resize(newsize=self.frame_size)
-        audio_clip = audio_clip.set_duration(final_clip.duration)
-        final_clip = final_clip.set_audio(audio_clip)
-        # Overlay subtitles
-        script_without_emojis, extracted_emojis = extract_and_remove_emojis(script)
-        final_clip = self.overlay_subtitles(final_clip, get_alignement(script_without_emojis, audio_object), script,
-                                            title, script_without_emojis, extracted_emojis)
+        if video_audio is None:
+            video_audio = self.mix_audio(audio_object, music_object)
 
-        # Save the video
-        video_file_path = os.path.join(self.video_dir, filename + ".mp4")
-        final_clip.fps = self.fps
-        final_clip.write_videofile(video_file_path, codec="libx264", preset="ultrafast", fps=10, bitrate="500k")
+        # Calculate the duration each media should be displayed to match the audio length, the crossfades overlap
+        audio_duration = video_audio.get_duration() + (fade_duration * (len(media_files) - 1))
+        media_paths = [os.path.join(self.media_folder, media_file) for media_file in media_files]
+        durations = allocate_durations(audio_duration, media_durations(media_entries.values()))
 
-        return video_file_path
+        script_without_emojis, extracted_emojis = extract_and_remove_emojis(script)
+        if alignment is None:
+            alignment = self.align_script(script, audio_object)
+
+        plan = VideoPlan()
+        plan.media_folder = self.media_folder
+        plan.media_paths = media_paths
+        plan.media_options = [media_entries[media_file]["options"] for media_file in media_files]
+        plan.durations = durations
+        plan.fade_duration = fade_duration
+        plan.audio_path = video_audio.file_path
+        plan.script = script
+        plan.title = title
+        plan.script_without_emojis = script_without_emojis
+        plan.extracted_emojis = extracted_emojis
+        plan.alignment = alignment
+        plan.frame_size = frame_size
+        plan.fps = fps
+        plan.profile = profile
+        plan.config = self.config
+        return plan
+
+    def media_timeline(self, plan):
+        # Each media is only opened while it is shown, a segment only opens the media it shows
+        timeline = MediaTimeline(plan.frame_size, plan.fade_duration)
+        for media_path, options, media_duration in zip(plan.media_paths, plan.media_options, plan.durations):
+            timeline.add_lazy(partial(load_media_clip, media_path, media_duration, options, plan.frame_size, plan.fps,
+                                      plan.config), media_duration)
+        return timeline
+
+    def build_clip(self, plan):
+        """
+        :return: The final clip of the plan: the media track with the subtitles and the title
+        """
+        # Only the one or two clips visible at a time are evaluated for each frame, the media are already fitted to
+        # the frame size so there is nothing to resize
+        with tracing.span("media_track"):
+            final_clip = self.media_timeline(plan).to_clip()
+        # Overlay subtitles, their layout is proportional to the frame size so a draft is laid out like the full video
+        with tracing.span("subtitles"):
+            return self.overlay_subtitles(final_clip, plan.alignment, plan.script, plan.title,
+                                          plan.script_without_emojis, plan.extracted_emojis)
+
+    def generate_video(self, audio_object, script, title, filename, music_object=None, draft=False, segments=None,
+                       video_audio=None, alignment=None):
+        """
+        Render the video and save it in video_dir.
+
+        :param draft: Render a preview at draft_scale of the frame size and draft_fps, saved as <filename>_draft.mp4.
+            The voice, alignment and music caches are shared with the full render.
+        :param segments: Number of segments rendered in parallel processes, encoding.segments by default
+        :param video_audio: The mixed audio, see plan_video
+        :param alignment: The alignment of the script, see plan_video
+        :return: The path of the video
+        """
+        with tracing.span("plan_video"):
+            plan = self.plan_video(audio_object, script, title, music_object, draft, video_audio, alignment)
+        output_path = video_file_path(self.video_dir, filename, draft)
+        segments = segments if segments is not None else self.config.encoding_segments
+        if segments > 1:
+            return self.render_segments(plan, output_path, segments)
+
+        # Save the video, streaming the frames to ffmpeg with the configured encoding profile
+        encoder = StreamingEncoder(output_path, plan.frame_size, plan.fps, plan.profile, audio_path=plan.audio_path,
+                                   queue_size=self.config.encoding_queue_size)
+        clip = self.build_clip(plan)
+        with tracing.span("encode", frames=int(clip.duration * plan.fps)):
+            encoder.encode(clip)
+
+        return output_path
+
+    def render_segments(self, plan, output_path, segments):
+        """
+        Render the video in segments cut at the end of crossfades, each one encoded without audio in its own process,
+        then join them without encoding the video again and add the audio. Every segment starts with a keyframe and
+        every frame is computed from its timestamp only, so the joined video is the same as one rendered in one go.
+        """
+        cuts = self.media_timeline(plan).segment_frames(segments, plan.fps)
+        segment_dir = tempfile.mkdtemp(prefix="segments_", dir=self.scratch_dir or self.video_dir)
+        try:
+            segment_paths = [os.path.join(segment_dir, f"segment_{i:03d}.mp4") for i in range(len(cuts) - 1)]
+            with ProcessPoolExecutor(max_workers=len(segment_paths)) as executor:
+                futures = [executor.submit(render_segment, plan, start, end, path)
+                           for start, end, path in zip(cuts, cuts[1:], segment_paths)]
+                for future in futures:
+                    future.result()
+            with tracing.span("concat_segments"):
+                concat_segments(segment_paths, output_path, plan.audio_path, plan.profile)
+        finally:
+            shutil.rmtree(segment_dir, ignore_errors=True)
+        return output_path
 
     def overlay_subtitles(self, final_clip, alignment, script, title, script_without_emojis, extracted_emojis):
-        clips_with_subtitles = []
+        # Words, shadows and title backgrounds are indexed by time and blended on each frame by the compositor
+        compositor = OverlayCompositor(final_clip.size)
         current_group = []
         last_end_time = 0
         font_size = self.config.subtitle_font_size
@@ -269,9 +398,9 @@ class VideoGeneration:
         def group_subtitles_by_lines(word_group: list[dict], max_words_per_line: int) -> list[list[dict]]:
             return [word_group[i:i + max_words_per_line] for i in range(0, len(word_group), max_words_per_line)]
 
-        def create_clips_for_subtitle(subtitle_text, font_size, font, shadow_offset, start_time, end_time,
-                                      current_vertical_pos, screen_width, vertical_line_space, proportion=0.8,
-                                      color='white', include_background=False):
+        def add_subtitle(subtitle_text, font_size, font, shadow_offset, start_time, end_time,
+                         current_vertical_pos, screen_width, vertical_line_space, proportion=0.8,
+                         color='white', include_background=False):
 
             # Split the subtitle text into words and emojis
             parts = list(filter(None, re.split(r'([^\x00-\x7F]+|\s+)', subtitle_text)))
@@ -281,8 +410,28 @@ class VideoGeneration:
             current_line_width = 0
             current_line_height = 0
             line_clips = []
-            all_clips = []
-            space_width = TextClip(" ", fontsize=font_size, color=color, font=font).w
+            space_width = self.text_renderer.space_width(font, font_size)
+
+            def add_line(line_clips, line_width, line_height, line_vertical_pos):
+                line_start_pos = screen_width // 2 - line_width // 2
+                if line_clips and include_background:
+                    # Add the background for this line
+                    compositor.add_rect((line_width, line_height), self.config.background_title,
+                                        self.config.background_title_opacity, (line_start_pos, line_vertical_pos),
+                                        start_time, end_time)
+
+                # Position the line's words and add them to the compositor
+                for rendered, offset, txt, is_emoji in line_clips:
+                    if is_emoji:
+                        position = (line_start_pos + offset, line_vertical_pos + rendered.h // 3)
+                    else:
+                        # Add shadow if it's a text clip
+                        shadow = self.text_renderer.render_word(txt, font, font_size, color, shadow=True)
+                        compositor.add(shadow.rgb, shadow.alpha, (line_start_pos + offset + shadow_offset,
+                                                                  line_vertical_pos + shadow_offset // 2),
+                                       start_time, end_time)
+                        position = (line_start_pos + offset, line_vertical_pos)
+                    compositor.add(rendered.rgb, rendered.alpha, position, start_time, end_time)
 
             first_word_in_line = True
 
@@ -290,47 +439,18 @@ class VideoGeneration:
                 if part.isspace():  # Skip pure whitespace
                     continue
 
-                # Create the clip and get its dimensions
-                if re.match(r'[^\x00-\x7F]+', part):  # For emojis
-                    clip = create_emoji_image_clip(part, font_size)  # Replace with your emoji to ImageClip function
+                # Rasterize the word and get its dimensions
+                is_emoji = bool(re.match(r'[^\x00-\x7F]+', part))
+                if is_emoji:
+                    rendered = self.text_renderer.render_emoji(part, font_size)
                 else:
-                    clip = TextClip(part, fontsize=font_size, color=color, font=font)
+                    rendered = self.text_renderer.render_word(part, font, font_size, color)
 
-                clip_w, clip_h = clip.w, clip.h
+                clip_w, clip_h = rendered.w, rendered.h
 
                 # Check if adding this word would exceed the max line width
                 if current_line_width + clip_w + (0 if first_word_in_line else space_width) > max_line_width:
-
-                    if include_background:
-                        # Create and position background for this line
-                        bg_clip = ColorClip(size=(current_line_width, current_line_height), color=self.config.background_title)
-                        bg_clip = bg_clip.set_opacity(self.config.background_title_opacity)
-                        bg_clip = bg_clip.set_duration(end_time - start_time)
-                        bg_clip = bg_clip.set_start(start_time).set_end(end_time)
-                        bg_clip = bg_clip.set_position(
-                            (screen_width // 2 - current_line_width // 2, current_vertical_pos))
-                        all_clips.append(bg_clip)
-
-                    # Position the current line's clips and add to all_clips
-                    line_start_pos = screen_width // 2 - current_line_width // 2
-                    for lc, offset, txt in line_clips:
-                        if isinstance(lc, TextClip):
-                            lc = lc.set_position((line_start_pos + offset, current_vertical_pos))
-                        else:
-                            lc = lc.set_position((line_start_pos + offset, current_vertical_pos + lc.h // 3))
-
-                        lc = lc.set_start(start_time).set_end(end_time)
-
-                        # Add shadow if it's a text clip
-                        if isinstance(lc, TextClip):
-                            shadow_clip = TextClip(txt, fontsize=font_size, color='black',
-                                                   font=font)
-                            shadow_clip = shadow_clip.set_position((line_start_pos + offset + shadow_offset,
-                                                                    current_vertical_pos + shadow_offset // 2))
-                            shadow_clip = shadow_clip.set_start(start_time).set_end(end_time).fx(vfx.colorx, 0.7)
-                            all_clips.append(shadow_clip)
-
-                        all_clips.append(lc)
+                    add_line(line_clips, current_line_width, current_line_height, current_vertical_pos)
 
                     # Update vertical position for the next line
                     current_vertical_pos += current_line_height + vertical_line_space
@@ -344,62 +464,34 @@ class VideoGeneration:
                 if not first_word_in_line:
                     current_line_width += space_width  # Add space between words
 
-                line_clips.append((clip, current_line_width, part))
+                line_clips.append((rendered, current_line_width, part, is_emoji))
                 current_line_width += clip_w
                 current_line_height = max(current_line_height, clip_h)
                 first_word_in_line = False
 
-            # Position and add the remaining clips in the last line
-            line_start_pos = screen_width // 2 - current_line_width // 2
-            if line_clips and include_background:
-                # Create and position background for this line
-                bg_clip = ColorClip(size=(current_line_width, current_line_height),
-                                    color=self.config.background_title)
-                bg_clip = bg_clip.set_opacity(self.config.background_title_opacity)
-                bg_clip = bg_clip.set_duration(end_time - start_time)
-                bg_clip = bg_clip.set_start(start_time).set_end(end_time)
-                bg_clip = bg_clip.set_position(
-                    (screen_width // 2 - current_line_width // 2, current_vertical_pos))
-                all_clips.append(bg_clip)
-            for lc, offset, txt in line_clips:
-                if isinstance(lc, TextClip):
-                    lc = lc.set_position((line_start_pos + offset, current_vertical_pos))
-                else:
-                    lc = lc.set_position((line_start_pos + offset, current_vertical_pos + lc.h // 3))
-                lc = lc.set_start(start_time).set_end(end_time)
-                # Add shadow if it's a text clip
-                if isinstance(lc, TextClip):
-                    shadow_clip = TextClip(txt, fontsize=font_size, color='black', font=font)
-                    shadow_clip = shadow_clip.set_position((line_start_pos + offset + shadow_offset,
-                                                            current_vertical_pos + shadow_offset // 2))
-                    shadow_clip = shadow_clip.set_start(start_time).set_end(end_time).fx(vfx.colorx, 0.7)
-                    all_clips.append(shadow_clip)
-
-                all_clips.append(lc)
-
-            return all_clips
+            # Position and add the remaining words in the last line
+            add_line(line_clips, current_line_width, current_line_height, current_vertical_pos)
 
         # handle title
         if self.config.show_title and title and not title.isspace():
             current_vertical_pos = vertical_pos
             if title and not title.isspace():
-                subtitle_clips = create_clips_for_subtitle(title, title_font_size, font, shadow_offset, 0,
-                                                           self.config.time_title,
-                                                           current_vertical_pos,
-                                                           screen_width=final_clip.w,
-                                                           vertical_line_space=title_font_size//5,
-                                                           color=self.config.color_title,
-                                                           include_background=True)
-                clips_with_subtitles.extend(subtitle_clips)
-
+                add_subtitle(title, title_font_size, font, shadow_offset, 0,
+                             self.config.time_title,
+                             current_vertical_pos,
+                             screen_width=final_clip.w,
+                             vertical_line_space=title_font_size//5,
+                             color=self.config.color_title,
+                             include_background=True)
+
+        composite = tracing.frame_timer("compositing", compositor.composite)
         if not script or script.isspace():
-            final_clip = CompositeVideoClip([final_clip] + clips_with_subtitles)
-            return final_clip
+            return final_clip.fl(lambda gf, t: composite(gf(t), t))
 
         filtered_words = [word for word in alignment['words'] if word['alignedWord'] != 'sp']
         aligned_word2text = match_aligned_words_to_text(filtered_words, script_without_emojis, extracted_emojis)
 
-        def add_clips_from_group(group, clips_with_subtitles, end_time):
+        def add_subtitles_from_group(group, end_time):
             start_time = current_group[0]['start']
             current_vertical_pos = vertical_pos
             if start_time < self.config.time_title and self.config.show_title:
@@ -414,17 +506,16 @@ class VideoGeneration:
 
                 if subtitle_text and not subtitle_text.isspace():
 
-                    subtitle_clips = create_clips_for_subtitle(subtitle_text, font_size, font,
-                                                               shadow_offset, start_time, end_time,
-                                                               current_vertical_pos,
-                                                               screen_width=final_clip.w,
-                                                               vertical_line_space=font_size // 5)
-                    clips_with_subtitles.extend(subtitle_clips)
+                    add_subtitle(subtitle_text, font_size, font,
+                                 shadow_offset, start_time, end_time,
+                                 current_vertical_pos,
+                                 screen_width=final_clip.w,
+                                 vertical_line_space=font_size // 5)
 
         for word in filtered_words:
             if (length_str + len(word['alignedWord']) > 5 * self.config.subtitle_nb_word) \
                     or (current_group and word['start'] - last_end_time > time_threshold):
-                add_clips_from_group(current_group, clips_with_subtitles, word['start'])
+                add_subtitles_from_group(current_group, word['start'])
 
                 current_group = []
                 length_str = 0
@@ -433,9 +524,8 @@ class VideoGeneration:
             length_str += len(word['alignedWord']) + 1
             last_end_time = word['end']
         if current_group:
-            add_clips_from_group(current_group, clips_with_subtitles, final_clip.duration)
-        final_clip = CompositeVideoClip([final_clip] + clips_with_subtitles)
-        return final_clip
+            add_subtitles_from_group(current_group, final_clip.duration)
+        return final_clip.fl(lambda gf, t: composite(gf(t), t))
 
 
 if __name__ == "__main__":
@@ -453,6 +543,6 @@ if __name__ == "__main__":
     audio_object = Audio(audio_file_path)
     # Generate video
     video_gen = VideoGeneration()
-    video_file_path = video_gen.generate_video(audio_object, text, title, "generated_video")
+    generated_path = video_gen.generate_video(audio_object, text, title, "generated_video")
 
-    print(f"Generated video saved at {video_file_path}")
+    print(f"Generated video saved at {generated_path}")